@@ -1,7 +1,7 @@
 import os
 import urllib.parse
 
-from zenpy.lib.api_objects import User, Identity
+from zenpy.lib.api_objects import User
 from zenpy.lib.exception import RecordNotFoundException
 
 from base_zendesk import BaseZendesk
@@ -22,11 +22,18 @@ class BaseMigration(BaseZendesk):
     original_id_field = None
 
     user_cache = {}
+    target_user_index = None
     org_cache = {}
+    target_org_index = None
     group_cache = {}
     ticket_field_cache = {}
     brand_cache = {}
     ticket_form_cache = {}
+    title_indexes = {}
+
+    # Up to this many new users are created with single requests instead of a create_many job
+    SYNC_CREATE_LIMIT = 3
+    unresolved_references = {}
 
     def __init__(self) -> None:
         super().__init__()
@@ -45,32 +52,50 @@ class BaseMigration(BaseZendesk):
                 break
 
     def get_target_org_id(self, source_org_id):
-        org_id = self.org_cache.get(source_org_id)
-        if not org_id:
-            try:
-                source_org = self.source_client.organizations(id=source_org_id)
-
-                org_id = None
-                if source_org:
-                    # Remove '&' char since they don't search well
-                    search_name = source_org.name.replace('&', '')
-                    for org in self.target_client.search(type='organization', name=search_name):
-                        if org.name == source_org.name:
-                            print('- Organization found for %s' % org.name)
-                            self.org_cache[source_org_id] = org.id
-                            break
-                else:
-                    print('WARN - Organization not found for %s' % source_org.name)
-
-            except RecordNotFoundException as e:
-                print('WARN - Organization not found for %s' % source_org_id)
+        # Misses are cached as None so the lookup is not repeated for every ticket from that org
+        if source_org_id in self.org_cache:
+            return self.org_cache.get(source_org_id)
+
+        self.populate_target_org_index()
+
+        org_id = None
+        source_org_name = self.get_source_org_name(source_org_id)
+        if source_org_name:
+            org_id = self.target_org_index.get(source_org_name)
+            if org_id:
+                print('- Organization found for %s' % source_org_name)
+            else:
+                print('WARN - Organization not found for %s' % source_org_name)
+        else:
+            print('WARN - Organization not found for %s' % source_org_id)
 
+        self.org_cache[source_org_id] = org_id
         return org_id
 
+    def get_source_org_name(self, source_org_id):
+        try:
+            source_org = self.source_client.organizations(id=source_org_id)
+            return source_org.name if source_org else None
+        except RecordNotFoundException as e:
+            return None
+
+    # Name -> id of every target organization, loaded once with the incremental organization export
+    def populate_target_org_index(self):
+        if self.target_org_index is None:
+            self.target_org_index = dict((org.name, org.id) for org in self.iter_target_orgs())
+
+    # Cached ids are returned as is, the target user is only fetched by get_target_user when it is needed
     def get_target_user_id(self, source_user_id):
-        return self.get_target_user(source_user_id).id
+        user_id = self.user_cache.get(int(source_user_id))
+        if user_id:
+            return user_id
+
+        user = self.get_target_user(source_user_id)
+        return user.id if user else None
 
     def get_target_user(self, source_user_id):
+        # Rule conditions and actions pass the id as a string
+        source_user_id = int(source_user_id)
         user_id = self.user_cache.get(source_user_id)
         user = None
         if not user_id:
@@ -86,31 +111,14 @@ class BaseMigration(BaseZendesk):
                 elif self.DEBUG:
                     print('- DEBUG Creating user: %s' % source.email)
                 else:
-                    new_user = User(email=source.email,
-                                    name=source.name,
-                                    locale_id=source.locale_id,
-                                    phone=source.phone,
-                                    role=source.role,
-                                    time_zone=source.time_zone,
-                                    verified=source.verified,
-                                    suspended=source.suspended,
-                                    tags=source.tags)
-                    if source.organization_id:
-                        new_org_id = self.get_target_org_id(source.organization_id)
-                        new_user.organization_id = new_org_id
+                    identities = [identity.to_dict() for identity in
+                                  self.source_client.users.identities(id=source_user_id)]
+                    new_user = self.new_target_user(source.to_dict(), identities)
 
                     print('- Creating user: %s' % new_user.email)
                     created_user = self.target_client.users.create(new_user)
                     user_id = created_user.id
 
-                    # Identities
-                    for source_identity in self.source_client.users.identities(id=source_user_id):
-                        if not source_identity.primary:
-                            identity = Identity(user_id=user_id,
-                                                type=source_identity.type,
-                                                value=source_identity.value)
-                            self.target_client.users.identities.create(user_id, identity)
-
                     user = created_user
 
                     if not created_user:
@@ -122,6 +130,110 @@ class BaseMigration(BaseZendesk):
 
         return user
 
+    # Build the target user from the source user json. Extra identities are created along with the user
+    def new_target_user(self, source, identities):
+        new_user = User(email=source.get('email'),
+                        name=source.get('name'),
+                        locale_id=source.get('locale_id'),
+                        phone=source.get('phone'),
+                        role=source.get('role'),
+                        time_zone=source.get('time_zone'),
+                        verified=source.get('verified'),
+                        suspended=source.get('suspended'),
+                        tags=source.get('tags'))
+        if source.get('organization_id'):
+            new_org_id = self.get_target_org_id(source.get('organization_id'))
+            new_user.organization_id = new_org_id
+
+        new_identities = []
+        for source_identity in identities:
+            if not source_identity.get('primary'):
+                new_identities.append({'type': source_identity.get('type'),
+                                       'value': source_identity.get('value')})
+        if len(new_identities) > 0:
+            new_user.identities = new_identities
+
+        return new_user
+
+    # Resolve a batch of source users and fill the user cache. Source users are fetched with show_many,
+    # matched against the target by email and the missing users are created with create_many jobs
+    def resolve_target_users(self, source_user_ids):
+        missing = []
+        for source_user_id in source_user_ids:
+            if source_user_id and not self.user_cache.get(source_user_id) and source_user_id not in missing:
+                missing.append(source_user_id)
+
+        if len(missing) == 0:
+            return
+
+        self.populate_target_user_index()
+
+        new_users = []
+        for chunk in self.chunks(missing, self.SHOW_MANY_LIMIT):
+            users, identities = self.get_source_users_json(chunk)
+            for source in users:
+                email = source.get('email')
+                user_id = self.target_user_index.get(email.lower()) if email else None
+                if user_id:
+                    print('- User found for %s' % email)
+                    self.user_cache[source.get('id')] = user_id
+                elif self.DEBUG:
+                    print('- DEBUG Creating user: %s' % email)
+                else:
+                    new_user = self.new_target_user(source, identities.get(source.get('id'), []))
+                    new_users.append((source.get('id'), new_user))
+
+        # A job costs at least one poll, a few users are quicker to create one by one
+        if len(new_users) <= self.SYNC_CREATE_LIMIT:
+            for source_id, new_user in new_users:
+                print('- Creating user: %s' % new_user.email)
+                created_user = self.target_client.users.create(new_user)
+                if created_user:
+                    self.user_cache[source_id] = created_user.id
+                    if new_user.email:
+                        self.target_user_index[new_user.email.lower()] = created_user.id
+                else:
+                    print('ERROR - Unable to create user %s' % new_user.email)
+            return
+
+        for chunk in self.chunks(new_users, self.SHOW_MANY_LIMIT):
+            print('- Creating %s users' % len(chunk))
+            job = self.target_client.users.create([new_user for (source_id, new_user) in chunk])
+            for finished in self.wait_for_jobs(self.target_client, [job]):
+                for position, result in enumerate(finished.results or []):
+                    if getattr(result, 'index', None) is not None:
+                        position = result.index
+                    user_id = getattr(result, 'id', None)
+                    if user_id and position < len(chunk):
+                        source_id, new_user = chunk[position]
+                        self.user_cache[source_id] = user_id
+                        if new_user.email:
+                            self.target_user_index[new_user.email.lower()] = user_id
+
+    # Source users json and their identities grouped by user id, fetched with show_many
+    def get_source_users_json(self, source_user_ids):
+        path = '/api/v2/users/show_many.json?ids=%s&include=identities' % ','.join(map(str, source_user_ids))
+        response_json = self.get_json_from_api(self.SOURCE_INSTANCE, path, self.source_auth)
+        if not response_json:
+            return [], {}
+
+        identities = {}
+        for identity in response_json.get('identities', []):
+            identities.setdefault(identity.get('user_id'), []).append(identity)
+
+        return response_json.get('users', []), identities
+
+    # Email -> id of every target user, loaded once with the incremental user export
+    def populate_target_user_index(self):
+        if self.target_user_index is None:
+            print('Loading target users')
+            self.target_user_index = {}
+            for user in self.target_client.users.incremental(start_time=0):
+                if user.email:
+                    self.target_user_index[user.email.lower()] = user.id
+
+            print('- Loaded %s target users' % len(self.target_user_index))
+
     def get_target_group_id(self, source_group_id):
         return self.get_target_entity_id('Group',
                                          source_group_id,
@@ -156,12 +268,12 @@ class BaseMigration(BaseZendesk):
 
     def get_target_entity_id(self, entity_name, source_id, cache, source_func, target_func, comparator):
         entity_id = cache.get(str(source_id))
-        if not entity_id:
-            entity = source_func(id=source_id)
+        if not entity_id and (entity_name, str(source_id)) not in self.unresolved_references:
+            entity = self.get_source_entity(entity_name, source_id, source_func)
             value = None
-            if comparator == 'name':
+            if entity and comparator == 'name':
                 value = entity.name
-            elif comparator == 'title':
+            elif entity and comparator == 'title':
                 value = entity.title
 
             print('- %s not in cache, retrieving for %s' % (entity_name, value))
@@ -183,10 +295,110 @@ class BaseMigration(BaseZendesk):
                         break
 
                 if not entity_id:
-                    print('ERROR - %s not found for %s' % (entity_name, value))
+                    # Reported once by print_unresolved_references
+                    self.unresolved_references[(entity_name, str(source_id))] = value
 
         return entity_id
 
+    # Source group, brand, ticket form or ticket field. Hook for reading them from somewhere else than the source
+    def get_source_entity(self, entity_name, source_id, source_func):
+        return source_func(id=source_id)
+
+    # Field of a rule condition or action -> entity of the id in its value
+    RULE_REFERENCE_FIELDS = {'group_id': 'Group',
+                             'brand_id': 'Brand',
+                             'assignee_id': 'User',
+                             'cc': 'User',
+                             'ticket_form_id': 'Ticket Form'}
+
+    # Scan the source triggers, macros or views for the ids they reference and resolve each entity type in bulk,
+    # so get_condition and get_action only read from the caches
+    def prepare_rule_translation(self, rules):
+        references = {'Group': set(), 'Brand': set(), 'User': set(), 'Ticket Form': set(), 'Ticket Field': set()}
+        for rule in rules:
+            items = list(getattr(rule, 'actions', None) or [])
+            conditions = getattr(rule, 'conditions', None)
+            if conditions:
+                items.extend(conditions.all or [])
+                items.extend(conditions.any or [])
+
+            for item in items:
+                field = item.get('field')
+                value = item.get('value')
+                if field.startswith('custom_fields'):
+                    references['Ticket Field'].add(field.rsplit('_')[2])
+                elif field in self.RULE_REFERENCE_FIELDS and isinstance(value, str) and str.isnumeric(value):
+                    references[self.RULE_REFERENCE_FIELDS.get(field)].add(value)
+
+            restriction = getattr(rule, 'restriction', None)
+            if restriction and restriction.get('type') == 'Group':
+                if restriction.get('id'):
+                    references['Group'].add(str(restriction.get('id')))
+                for group_id in restriction.get('ids') or []:
+                    references['Group'].add(str(group_id))
+
+            execution = getattr(rule, 'execution', None)
+            if execution:
+                for column in execution.get('columns') or []:
+                    if isinstance(column.get('id'), int):
+                        references['Ticket Field'].add(str(column.get('id')))
+
+        print('Resolving rule references: %s' %
+              ', '.join('%s %s' % (len(ids), name) for (name, ids) in references.items()))
+
+        self.resolve_target_entities('Group', references['Group'], self.group_cache,
+                                     self.source_client.groups, self.target_client.groups, 'name')
+        self.resolve_target_entities('Brand', references['Brand'], self.brand_cache,
+                                     self.source_client.brands, self.target_client.brands, 'name')
+        self.resolve_target_entities('Ticket Form', references['Ticket Form'], self.ticket_form_cache,
+                                     self.source_client.ticket_forms, self.target_client.ticket_forms, 'name')
+        self.resolve_target_entities('Ticket Field', references['Ticket Field'], self.ticket_field_cache,
+                                     self.source_client.ticket_fields, self.target_client.ticket_fields, 'title')
+        self.resolve_target_users([int(user_id) for user_id in references['User']])
+
+    # Bulk version of get_target_entity_id, lists the source and target collections once
+    def resolve_target_entities(self, entity_name, source_ids, cache, source_func, target_func, comparator):
+        missing = [str(source_id) for source_id in source_ids if not cache.get(str(source_id))]
+        if len(missing) == 0:
+            return
+
+        source_values = {}
+        for entity in source_func():
+            source_values[str(entity.id)] = getattr(entity, comparator)
+
+        target_ids = {}
+        for entity in target_func():
+            target_ids.setdefault(getattr(entity, comparator), entity.id)
+
+        for source_id in missing:
+            value = source_values.get(source_id)
+            target_id = target_ids.get(value) if value is not None else None
+            if target_id:
+                cache[source_id] = target_id
+            else:
+                self.unresolved_references[(entity_name, source_id)] = value
+
+    def print_unresolved_references(self):
+        if len(self.unresolved_references) > 0:
+            print('')
+            print('Unresolved references:')
+            for (entity_name, source_id), value in sorted(self.unresolved_references.items()):
+                print('- %s %s: %s' % (entity_name, source_id, value if value is not None else 'not found in source'))
+
+    # Title -> id of a target business rule collection (triggers, macros, views), listed once and kept
+    # up to date by the migrators as they create new items
+    def get_target_title_index(self, name, target_func):
+        index = self.title_indexes.get(name)
+        if index is None:
+            index = {}
+            for existing in target_func():
+                index[existing.title] = existing.id
+
+            print('- Loaded %s target %s' % (len(index), name))
+            self.title_indexes[name] = index
+
+        return index
+
     def find_target_ticket_for_original_id(self, ticket_id):
         result = None
         for ticket in self.target_client.search(type='ticket', fieldvalue=ticket_id):
@@ -1,10 +1,28 @@
+import concurrent.futures
 import os
+import queue
+import threading
+import time
 
 import requests
 import requests.auth
+from requests.adapters import HTTPAdapter
 from zenpy import Zenpy
 
 
+# Session for the Zenpy clients, so their requests share the rate limit of BaseZendesk.api_request. Zenpy waits
+# out the 429 responses itself
+class RateLimitedSession(requests.Session):
+
+    def __init__(self):
+        super(RateLimitedSession, self).__init__()
+        self.mount('https://', HTTPAdapter(**Zenpy.http_adapter_kwargs()))
+
+    def request(self, method, url, *args, **kwargs):
+        BaseZendesk.wait_for_rate_limit()
+        return super(RateLimitedSession, self).request(method, url, *args, **kwargs)
+
+
 class BaseZendesk(object):
 
     # Source Zendesk
@@ -22,19 +40,235 @@ class BaseZendesk(object):
 
     source_client = Zenpy(email=ZENDESK_SOURCE_EMAIL,
                           password=ZENDESK_SOURCE_PASSWORD,
-                          subdomain=SOURCE_INSTANCE)
+                          subdomain=SOURCE_INSTANCE,
+                          session=RateLimitedSession())
 
     target_client = Zenpy(email=ZENDESK_TARGET_EMAIL,
                           password=ZENDESK_TARGET_PASSWORD,
-                          subdomain=TARGET_INSTANCE)
+                          subdomain=TARGET_INSTANCE,
+                          session=RateLimitedSession())
 
     source_auth = requests.auth.HTTPBasicAuth(ZENDESK_SOURCE_EMAIL, ZENDESK_SOURCE_PASSWORD)
     target_auth = requests.auth.HTTPBasicAuth(ZENDESK_TARGET_EMAIL, ZENDESK_TARGET_PASSWORD)
 
+    # Max number of ids accepted by the show_many endpoints
+    SHOW_MANY_LIMIT = 100
+
+    # Incremental exports return full pages until the end of the stream
+    INCREMENTAL_PAGE_SIZE = 1000
+
+    # Zendesk only allows a limited number of background jobs to be queued at once
+    MAX_QUEUED_JOBS = 30
+    # Small jobs usually finish within a second, the poll interval doubles up to JOB_POLL_INTERVAL
+    JOB_FIRST_POLL_INTERVAL = 0.5
+    JOB_POLL_INTERVAL = 5
+
+    # Worker threads used for concurrent requests
+    MAX_WORKERS = int(os.getenv('ZENDESK_MAX_WORKERS', 8))
+
+    # Items waiting between two pipeline stages, and how often the queue depths are printed
+    PIPELINE_QUEUE_SIZE = 50
+    PIPELINE_REPORT_INTERVAL = 30
+
+    # Requests per minute shared by all threads for the calls made through api_request and the Zenpy clients.
+    # 0 means no limit, 429 responses are always waited out
+    RATE_LIMIT = int(os.getenv('ZENDESK_RATE_LIMIT', 0))
+    rate_limit_lock = threading.Lock()
+    next_request_time = 0
+
+    # Marks the worker threads of run_concurrently
+    pool_local = threading.local()
+
+    # Run func for each item on a pool of worker threads. At most twice the number of workers are in flight,
+    # so large generators are not read into memory. Yields (item, result, error) as the calls complete.
+    # Called from a worker of another run_concurrently the items are run in the calling thread, so nested calls
+    # stay within MAX_WORKERS threads
+    def run_concurrently(self, func, items, max_workers=None):
+        if getattr(BaseZendesk.pool_local, 'in_pool', False):
+            for item in items:
+                try:
+                    yield item, func(item), None
+                except Exception as e:
+                    yield item, None, e
+            return
+
+        def pool_func(item):
+            BaseZendesk.pool_local.in_pool = True
+            return func(item)
+
+        max_workers = max_workers or self.MAX_WORKERS
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = {}
+            for item in items:
+                in_flight[executor.submit(pool_func, item)] = item
+                if len(in_flight) >= max_workers * 2:
+                    done, not_done = concurrent.futures.wait(in_flight,
+                                                             return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield self.future_result(in_flight.pop(future), future)
+
+            for future in concurrent.futures.as_completed(list(in_flight)):
+                yield self.future_result(in_flight.pop(future), future)
+
+    def future_result(self, item, future):
+        error = future.exception()
+        if error:
+            return item, None, error
+        return item, future.result(), None
+
+    # Run items through stages connected by bounded queues. Each stage is (name, func, workers), func is called
+    # with the item from the previous stage and returns the item for the next stage, or None to drop it. A stage
+    # given as (name, func, workers, batch_size) is called with a list of up to batch_size queued items and
+    # returns the list of items for the next stage. Errors are printed and the items dropped. Yields the items
+    # coming out of the last stage and prints the queue depths every PIPELINE_REPORT_INTERVAL sec, a full queue
+    # is in front of the slowest stage
+    def run_pipeline(self, items, stages):
+        done = object()
+        queues = [queue.Queue(maxsize=self.PIPELINE_QUEUE_SIZE) for stage in stages]
+        output = queue.Queue(maxsize=self.PIPELINE_QUEUE_SIZE)
+        queues.append(output)
+
+        def feed():
+            try:
+                for item in items:
+                    queues[0].put(item)
+            except Exception as e:
+                print('ERROR - Pipeline input failed: %s' % e)
+            finally:
+                for worker in range(stages[0][2]):
+                    queues[0].put(done)
+
+        def work(position, remaining):
+            name, func = stages[position][:2]
+            batch_size = stages[position][3] if len(stages[position]) > 3 else None
+            finished = False
+            while not finished:
+                item = queues[position].get()
+                if item is done:
+                    break
+                try:
+                    if batch_size:
+                        # Take whatever else is already queued, up to the batch size
+                        batch = [item]
+                        while len(batch) < batch_size:
+                            try:
+                                item = queues[position].get_nowait()
+                            except queue.Empty:
+                                break
+                            if item is done:
+                                finished = True
+                                break
+                            batch.append(item)
+
+                        results = func(batch)
+                    else:
+                        results = [func(item)]
+
+                    for result in results:
+                        if result is not None:
+                            queues[position + 1].put(result)
+                except Exception as e:
+                    print('ERROR - Pipeline stage %s failed: %s' % (name, e))
+
+            # The last worker of the stage to finish tells the next stage there is nothing more to come
+            with remaining['lock']:
+                remaining['workers'] -= 1
+                last = remaining['workers'] == 0
+            if last:
+                next_workers = stages[position + 1][2] if position + 1 < len(stages) else 1
+                for worker in range(next_workers):
+                    queues[position + 1].put(done)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for position, stage in enumerate(stages):
+            remaining = {'lock': threading.Lock(), 'workers': stage[2]}
+            for worker in range(stage[2]):
+                threads.append(threading.Thread(target=work, args=(position, remaining), daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        last_report = time.time()
+        while True:
+            try:
+                item = output.get(timeout=1)
+            except queue.Empty:
+                item = None
+
+            if item is done:
+                break
+            elif item is not None:
+                yield item
+
+            if time.time() - last_report > self.PIPELINE_REPORT_INTERVAL:
+                last_report = time.time()
+                print('*** Queue depths: %s' % ', '.join('%s=%s' % (stage[0], queues[position].qsize())
+                                                         for position, stage in enumerate(stages)))
+
+    # Split an iterable into lists of at most size items, without loading the whole iterable
+    def chunks(self, iterable, size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    # Wait for background jobs (create_many, update_many, ...) to finish. All pending jobs are polled
+    # together with the show_many endpoint. Returns the finished job statuses
+    def wait_for_jobs(self, client, job_statuses):
+        pending = [job.id for job in job_statuses if job]
+        finished = []
+        interval = self.JOB_FIRST_POLL_INTERVAL
+        while pending:
+            time.sleep(interval)
+            interval = min(interval * 2, self.JOB_POLL_INTERVAL)
+            still_pending = []
+            for chunk in self.chunks(pending, self.SHOW_MANY_LIMIT):
+                for job in client.job_status(ids=chunk):
+                    if job.status in ('completed', 'failed', 'killed'):
+                        finished.append(job)
+                        self.print_job_status(job)
+                    else:
+                        still_pending.append(job.id)
+
+            pending = still_pending
+
+        return finished
+
+    def print_job_status(self, job):
+        failures = 0
+        for result in job.results or []:
+            error = getattr(result, 'error', None) or getattr(result, 'errors', None)
+            if error or getattr(result, 'status', None) == 'Failed':
+                failures += 1
+                print('API: Job %s item %s failed: %s %s' % (job.id, getattr(result, 'id', None), error,
+                                                             getattr(result, 'details', '')))
+
+        print('API: Job %s %s - %s results, %s failed' % (job.id, job.status, len(job.results or []), failures))
+
+    # Yield the target organizations that are not deleted, using the incremental organization export
+    def iter_target_orgs(self):
+        print('Loading target organizations')
+        count = 0
+        for org in self.target_client.organizations.incremental(start_time=0):
+            if not getattr(org, 'deleted_at', None):
+                count += 1
+                yield org
+
+        print('- Loaded %s target organizations' % count)
+
     # Return a json array of entities. Used for entities that are not in Zenpy
     def get_list_from_api(self, instance, path, auth, entity_name, page=None):
 
-        return_array = []
+        return list(self.iter_list_from_api(instance, path, auth, entity_name, page))
+
+    # Yield the entities page by page instead of building the whole list. Used for entities that are not in Zenpy
+    def iter_list_from_api(self, instance, path, auth, entity_name, page=None):
+
         next_url = self.URL % (instance, path)
 
         if page is not None and page > 0:
@@ -44,14 +278,17 @@ class BaseZendesk(object):
                 next_url = '%s?page=%s' % (next_url, page)
 
         while next_url:
-            response = requests.get(next_url, auth=auth)
+            response = self.api_get(next_url, auth=auth)
             response_json = response.json()
             entity_json = response_json.get(entity_name)
             if entity_json is not None and len(entity_json) > 0:
                 print('API: Retrieved list of %s with length %s' % (entity_name, len(entity_json)))
+                next_url = response_json.get('next_page')
+                # Cursor paginated endpoints
+                if response_json.get('meta', {}).get('has_more'):
+                    next_url = response_json.get('links', {}).get('next')
                 for entity in entity_json:
-                    return_array.append(entity)
-                    next_url = response_json.get('next_page')
+                    yield entity
             else:
                 next_url = None
                 print('API: No %s returned' % entity_name)
@@ -59,7 +296,65 @@ class BaseZendesk(object):
             if page is not None and page > 0:
                 next_url = None
 
-        return return_array
+    # GET that waits out 429 responses. Needed when several workers share the rate limit
+    def api_get(self, url, auth=None, **kwargs):
+
+        return self.api_request(requests.get, url, auth=auth, **kwargs)
+
+    def api_request(self, method, url, auth=None, **kwargs):
+
+        while True:
+            self.wait_for_rate_limit()
+            response = method(url, auth=auth, **kwargs)
+            if not response.status_code == 429:
+                return response
+
+            retry_after = int(response.headers.get('retry-after', 60))
+            print('API: Rate limited, retrying in %s sec' % retry_after)
+            time.sleep(retry_after)
+
+    # Space out the requests of all threads to stay under RATE_LIMIT requests per minute
+    @classmethod
+    def wait_for_rate_limit(cls):
+        if cls.RATE_LIMIT > 0:
+            with BaseZendesk.rate_limit_lock:
+                now = time.time()
+                wait = BaseZendesk.next_request_time - now
+                BaseZendesk.next_request_time = max(now, BaseZendesk.next_request_time) + 60.0 / cls.RATE_LIMIT
+
+            if wait > 0:
+                time.sleep(wait)
+
+    # Yield each page of a time based incremental export, following next_page until the end of the stream
+    def get_incremental_pages_from_api(self, instance, path, auth):
+
+        url = self.URL % (instance, path)
+        while url:
+            response = self.api_get(url, auth=auth)
+            if not response.status_code == 200:
+                print('API: Error retrieving %s, status=%s: %s' % (url, response.status_code, response.content))
+                break
+
+            response_json = response.json()
+            yield response_json
+
+            if response_json.get('end_of_stream') or response_json.get('count', 0) < self.INCREMENTAL_PAGE_SIZE:
+                url = None
+            else:
+                url = response_json.get('next_page')
+
+    # Return the whole json response. Used when side-loaded entities are needed
+    def get_json_from_api(self, instance, path, auth):
+
+        return_val = None
+        url = self.URL % (instance, path)
+        response = self.api_get(url, auth=auth)
+        if response.status_code == 200:
+            return_val = response.json()
+        else:
+            print('API: Error retrieving %s, status=%s: %s' % (url, response.status_code, response.content))
+
+        return return_val
 
     def get_from_api(self, instance, path, auth, entity_name):
 
@@ -110,8 +405,11 @@ class BaseZendesk(object):
     # Delete the json entity. Used for entities that are not in Zenpy
     def delete_at_api(self, instance, path, auth):
 
-        return_val = None
+        return_val = True
         url = self.URL % (instance, path)
-        response = requests.delete(url, auth=auth)
+        response = self.api_request(requests.delete, url, auth=auth)
         if not response.status_code == 204:
+            return_val = False
             print('API: Error deleting, path=%s, status=%s: %s' % (url, response.status_code, response.content))
+
+        return return_val
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 
 """
-Produces a JSON dump of all Community content. Includes the following
+Produces a JSON lines (NDJSON) dump of all Community content. Includes the following
 - Topics
 - Posts
 - Post Comments
 - Article Comments
 
+Each resource is written as it is retrieved and the comments are fetched concurrently. Completed
+resources and parent ids are recorded in a checkpoint file, so an interrupted export resumes where it stopped.
+Delete the checkpoint file to start over.
+
 """
 import json
+import os
 import sys
 
 from base_zendesk import BaseZendesk
@@ -16,37 +21,94 @@ from base_zendesk import BaseZendesk
 
 class CommunityExport(BaseZendesk):
 
+    CHECKPOINT_FILE = 'community_export.checkpoint'
+
+    checkpoint = set()
+
     def main(self):
 
-        topics = self.get_list_from_api(self.SOURCE_INSTANCE,
-                                        '/api/v2/community/topics.json',
-                                        self.source_auth,
-                                        'topics')
-        with open('community_topics.json', 'w') as file:
-            json.dump(topics, file)
-
-        posts = self.get_list_from_api(self.SOURCE_INSTANCE,
-                                       '/api/v2/community/posts.json',
-                                       self.source_auth,
-                                       'posts')
-        with open('community_posts.json', 'w') as file:
-            json.dump(posts, file)
-
-        post_comments = []
-        for post in posts:
-            url = '/api/v2/community/posts/%s/comments.json' % post.get('id')
-            post_comments.extend(self.get_list_from_api(self.SOURCE_INSTANCE, url, self.source_auth, 'comments'))
-
-        with open('community_post_comments.json', 'w') as file:
-            json.dump(post_comments, file)
-
-        article_comments = []
-        for article in self.source_client.help_center.articles():
-            url = '/api/v2/help_center/articles/%s/comments.json' % article.id
-            article_comments.extend(self.get_list_from_api(self.SOURCE_INSTANCE, url, self.source_auth, 'comments'))
-
-        with open('community_article_comments.json', 'w') as file:
-            json.dump(article_comments, file)
+        self.load_checkpoint()
+
+        self.export_list('topics', '/api/v2/community/topics.json', 'topics', 'community_topics.jsonl')
+        self.export_list('posts', '/api/v2/community/posts.json', 'posts', 'community_posts.jsonl')
+
+        # Post ids come from the export file so they are not held in memory
+        post_ids = self.read_ids('community_posts.jsonl')
+        self.export_comments('post', post_ids, '/api/v2/community/posts/%s/comments.json',
+                             'community_post_comments.jsonl')
+
+        article_ids = (article.get('id') for article in self.iter_list_from_api(self.SOURCE_INSTANCE,
+                                                                                '/api/v2/help_center/articles.json',
+                                                                                self.source_auth,
+                                                                                'articles'))
+        self.export_comments('article', article_ids, '/api/v2/help_center/articles/%s/comments.json',
+                             'community_article_comments.jsonl')
+
+        print('Export complete')
+
+    def export_list(self, name, path, entity_name, filename):
+        if self.is_done('resource', name):
+            print('Skipping %s, already exported' % name)
+            return
+
+        counter = 0
+        with open(filename, 'w') as file:
+            for entity in self.iter_list_from_api(self.SOURCE_INSTANCE, path, self.source_auth, entity_name):
+                file.write(json.dumps(entity) + '\n')
+                counter += 1
+
+        print('Exported %s %s' % (counter, name))
+        self.mark_done('resource', name)
+
+    def export_comments(self, parent_type, parent_ids, path, filename):
+        pending_ids = (parent_id for parent_id in parent_ids if not self.is_done(parent_type, parent_id))
+
+        def fetch_comments(parent_id):
+            return self.get_list_from_api(self.SOURCE_INSTANCE, path % parent_id, self.source_auth, 'comments')
+
+        # Append only when resuming, a fresh export starts the file over
+        resuming = any(entry.startswith('%s ' % parent_type) for entry in self.checkpoint)
+
+        counter = 0
+        with open(filename, 'a' if resuming else 'w') as file:
+            for parent_id, comments, error in self.run_concurrently(fetch_comments, pending_ids):
+                if error:
+                    print('ERROR - Unable to export comments for %s %s: %s' % (parent_type, parent_id, error))
+                    continue
+
+                for comment in comments:
+                    file.write(json.dumps(comment) + '\n')
+                file.flush()
+
+                # Only checkpoint once the comments are written
+                self.mark_done(parent_type, parent_id)
+                counter += 1
+                if counter % 100 == 0:
+                    print('*** Exported comments for %s %ss' % (counter, parent_type))
+
+        print('Exported comments for %s %ss' % (counter, parent_type))
+
+    def read_ids(self, filename):
+        with open(filename, 'r') as file:
+            for line in file:
+                yield json.loads(line).get('id')
+
+    def load_checkpoint(self):
+        self.checkpoint = set()
+        if os.path.exists(self.CHECKPOINT_FILE):
+            with open(self.CHECKPOINT_FILE, 'r') as file:
+                for line in file:
+                    self.checkpoint.add(line.strip())
+            print('Resuming export, %s entries in checkpoint' % len(self.checkpoint))
+
+    def is_done(self, entry_type, entry_id):
+        return '%s %s' % (entry_type, entry_id) in self.checkpoint
+
+    def mark_done(self, entry_type, entry_id):
+        entry = '%s %s' % (entry_type, entry_id)
+        self.checkpoint.add(entry)
+        with open(self.CHECKPOINT_FILE, 'a') as file:
+            file.write(entry + '\n')
 
 
 if __name__ == '__main__':
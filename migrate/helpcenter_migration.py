@@ -4,17 +4,31 @@
 Migrates the article content from one help center instance to another. This script loops through the list of
 categories and will copy the content.
 
-Can be run as a script that takes up to 3 command line arguments, which can be the following:
-- action - migrate, update_links, purge, permissions, check, check_and_update
+Can be run as a script that takes up to 4 command line arguments, which can be the following:
+- action - migrate, update_links, purge, permissions, check, check_and_update, sync
 - start_id (optional) - The source category id to start with. This is useful after a restart
-- single_run (optional) - Set to true if you want to only run one category
+- single_run (optional) - Set to 1 if you want to only run one category
+- parallel (optional) - Set to 1 to process the articles of several sections concurrently. Use 0 for start_id
+  and single_run to run all categories
+
+The sync action updates only the articles changed since the last sync, using the help center incremental
+export. Its state is kept in help-center-sync.json. The first run needs a start time (epoch seconds), usually the
+time of the initial migration.
+
+The purge action deletes all categories, sections and articles in the target. Pass 1 as the second argument for a
+dry run that only counts them.
 
 """
 import csv
+import hashlib
+import json
 import os
 import re
 import sys
 import tempfile
+import threading
+import time
+import urllib.parse
 
 import requests
 from requests import RequestException
@@ -34,22 +48,59 @@ class HelpcenterMigration(BaseMigration):
     TARGET_HELPCENTER_DOMAIN = os.getenv('ZENDESK_TARGET_HELPCENTER_DOMAIN', None)
 
     REPORT_FILE = 'help-center-report.csv'
+    REPORT_BUFFER_SIZE = 1024 * 1024
+
+    # Max number of attachments accepted by the bulk_attachments endpoint
+    BULK_ATTACHMENTS_LIMIT = 20
 
-    target_categories = []
-    target_sections = {}
-    target_articles = {}
+    # Link checker settings. Urls are probed once per run, with at most HOST_MAX_CONNECTIONS at a time per host
+    PROBE_TIMEOUT = 30
+    HOST_MAX_CONNECTIONS = 4
+    probe_cache = {}
+    host_semaphores = {}
+    host_semaphores_lock = threading.Lock()
+
+    # (type, parent id, name) -> {'id', 'name'} for the target categories, sections and articles.
+    # Only these fields are kept so article bodies are not held in memory
+    target_directory = {}
 
     user_segment_cache = {}
 
-    def main(self, start_category_id=None, single=False, action='migrate'):
+    # Sync state: the incremental export start time, and by source article id the body hash at the last sync,
+    # the target article id and the articles that failed to sync
+    SYNC_STATE_FILE = 'help-center-sync.json'
+    source_section_cache = {}
+    synced_sections = set()
+
+    # Link rewrite caches for update_links
+    link_cache = {}
+    redirect_cache = {}
+    source_link_names = None
+    target_link_ids = None
+
+    def main(self, start_category_id=None, single=False, action='migrate', parallel=False):
         self.populate_target_categories()
 
-        if action == 'check':
-            with open(self.REPORT_FILE, 'w+') as csvfile:
-                csvwriter = csv.writer(csvfile, delimiter=',',
-                                       quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                csvwriter.writerow(['category', 'section', 'article', 'type', 'url', 'status'])
+        if action == 'check' or action == 'check_and_update':
+            self.check_articles(start_category_id, single, remigrate=(action == 'check_and_update'))
+        elif parallel:
+            # Categories and sections are created in order, the articles of each section are processed by
+            # a pool of workers
+            def process_item(item):
+                source_section, section, category = item
+                self.process_section_articles(source_section, section, category, action)
+
+            sections = self.iter_sections(start_category_id, single)
+            for (source_section, section, category), result, error in self.run_concurrently(process_item, sections):
+                if error:
+                    print('ERROR processing section %s - %s: %s' % (source_section.id, source_section.name, error))
+                else:
+                    print('Completed Section %s - %s' % (source_section.id, source_section.name))
+        else:
+            for source_category in self.iter_source_categories(start_category_id, single):
+                self.process_category(source_category, action)
 
+    def iter_source_categories(self, start_category_id=None, single=False):
         # Categories
         start = False if start_category_id and start_category_id > 0 else True
         for source_category in self.source_client.help_center.categories():
@@ -57,275 +108,465 @@ class HelpcenterMigration(BaseMigration):
                 start = True
 
             if start:
-                self.process_category(source_category, action)
+                yield source_category
                 if single:
                     break
 
+    # Yield (source section, target section, target category) once the target section exists
+    def iter_sections(self, start_category_id=None, single=False):
+        for source_category in self.iter_source_categories(start_category_id, single):
+            category = self.get_target_category(source_category)
+            self.populate_target_sections(category.get('id'))
+            for source_section in self.source_client.help_center.categories.sections(category_id=source_category.id):
+                yield source_section, self.get_target_section(source_section, category), category
+
     def process_category(self, source_category, action='migrate'):
-        # Look for existing
-        category = None
-        for existing_category in self.target_categories:
-            if source_category.name == existing_category.name:
-                print('Found Category %s - %s' % (source_category.id, source_category.name))
-                category = existing_category
+        category = self.get_target_category(source_category)
 
-        if not category:
+        # Migrate sections
+        self.populate_target_sections(category.get('id'))
+        for section in self.source_client.help_center.categories.sections(category_id=source_category.id):
+            self.process_section(section, category, action)
+
+        print('')
+
+    def get_target_category(self, source_category):
+        # Look for existing
+        category = self.target_directory.get(('category', None, source_category.name))
+        if category:
+            print('Found Category %s - %s' % (source_category.id, source_category.name))
+        else:
             new_category = Category(name=source_category.name,
                                     description=source_category.description,
                                     position=source_category.position)
             print('Creating Category for %s - %s' % (source_category.id, source_category.name))
-            category = self.target_client.help_center.categories.create(new_category)
-
-        print('')
-
-        # Migrate sections
-        self.populate_target_sections(category.id)
-        for section in self.source_client.help_center.categories.sections(category_id=source_category.id):
-            self.process_section(section, category, action)
+            category = self.add_to_directory('category', None,
+                                             self.target_client.help_center.categories.create(new_category))
 
         print('')
+        return category
 
     def process_section(self, source_section, category, action='migrate'):
-        # Look for existing
-        section = None
-        for existing_section in self.target_sections.get(category.id):
-            if source_section.name == existing_section.name and existing_section.category_id == category.id:
-                print('Found Section %s - %s' % (source_section.id, source_section.name))
-                section = existing_section
+        section = self.get_target_section(source_section, category)
+        self.process_section_articles(source_section, section, category, action)
 
-        if not section:
+    def get_target_section(self, source_section, category):
+        # Look for existing
+        section = self.target_directory.get(('section', category.get('id'), source_section.name))
+        if section:
+            print('Found Section %s - %s' % (source_section.id, source_section.name))
+        else:
             new_section = Section(name=source_section.name,
                                   description=source_section.description,
                                   position=source_section.position,
                                   manageable_by=source_section.manageable_by,
                                   locale=source_section.locale,
                                   sorting=source_section.sorting,
-                                  category_id=category.id)
+                                  category_id=category.get('id'))
             print('Creating Section for %s - %s' % (source_section.id, source_section.name))
-            section = self.target_client.help_center.sections.create(new_section)
+            section = self.add_to_directory('section', category.get('id'),
+                                            self.target_client.help_center.sections.create(new_section))
 
         print('')
+        return section
 
+    def process_section_articles(self, source_section, section, category, action='migrate'):
         # Migrate articles
-        self.populate_target_articles(section.id)
+        self.populate_target_articles(section.get('id'))
         articles = self.source_client.help_center.sections.articles(section=source_section)
         for article in articles:
             if action == 'migrate':
-                self.migrate_article(article, section.id)
-            elif action == 'check_and_update':
-                self.check_article(article, category.name, section, remigrate=True)
-            elif action == 'check':
-                self.check_article(article, category.name, section)
+                self.migrate_article(article, section.get('id'))
 
     def migrate_article(self, source, section_id, force=False):
 
         # Look for existing
         if not force:
-            for existing_article in self.target_articles.get(section_id):
-                if source.name == existing_article.name and existing_article.section_id == section_id:
-                    print('Found Article %s - %s, not migrating' % (source.id, source.name))
-                    return existing_article
+            existing_article = self.target_directory.get(('article', section_id, source.name))
+            if existing_article:
+                print('Found Article %s - %s, not migrating' % (source.id, source.name))
+                return existing_article
 
         print('Creating Article %s - %s' % (source.id, source.name))
+
+        # Upload the inline images and the attachments first, so the article is created with its final body
+        uploads = self.upload_article_attachments(source)
+        body = self.rewrite_body(source.body, uploads)
+
         article = Article(title=source.title,
+                          body=body,
+                          draft=source.draft,
                           label_names=source.label_names,
                           comments_disabled=source.comments_disabled,
                           promoted=source.promoted,
                           position=source.position)
 
-        article.body = source.body
-
         # User Segment
         if source.user_segment_id:
             segment_id = self.get_target_user_segment(source.user_segment_id)
             article.user_segment_id = segment_id
 
         print('- Creating article %s' % article.title)
-        article_id = self.target_client.help_center.articles.create(section=section_id, article=article).id
-        article = self.target_client.help_center.articles(id=article_id)
-        article_body = article.body
+        article = self.target_client.help_center.articles.create(section=section_id, article=article)
 
-        changes = False
-        trans = Translation(body=article_body, locale='en-us')
+        self.associate_attachments(article, uploads)
 
-        # Draft status
-        if source.draft:
-            trans.draft = True
-            changes = True
+        entry = self.add_to_directory('article', section_id, article)
 
-        # Inline Attachments
-        matches = re.findall(self.IMG_SRC_PATTERN, article_body)
-        for match in matches:
-            update_att = False
-            url = match
-            source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
-            if match.startswith(source_domain) or \
-                    match.startswith('https://%s' % self.SOURCE_HELPCENTER_DOMAIN):
-                update_att = True
-            elif match.startswith('/attachments'):
-                update_att = True
-                url = 'https://%s.zendesk.com%s' % (self.SOURCE_INSTANCE, match)
-
-            if update_att:
-                response = requests.get(url, auth=self.source_auth)
-
-                if not response.status_code == 200:
-                    print('- ERROR getting attachment %s: %s' % (url, response.status_code))
-                    continue
-
-                content_disp = response.headers.get('content-disposition')
-                file_name = re.search('inline; filename=\"(.*)\"', content_disp).group(1)
-                content_type = response.headers.get('content-type')
-                with tempfile.TemporaryFile() as tmp_file:
-                    tmp_file.write(response.content)
-                    tmp_file.seek(0)
-                    upload = self.target_client.help_center.attachments.create(article=article,
-                                                                               attachment=tmp_file,
-                                                                               inline=True,
-                                                                               file_name=file_name,
-                                                                               content_type=content_type)
-                    print('- Attachment created - %s' % file_name)
-
-                    # Search/replace the image
-                    changes = True
-                    article_body = article_body.replace(match, upload.relative_path)
-                    trans.body = article_body
-
-        # Non-inline attachments
-        # Attachments
-        for attachment in self.source_client.help_center.attachments(article=source.id):
+        print('')
+        return entry
+
+    # Copy the inline images and the regular attachments of the source article as unassociated attachments on
+    # the worker pool. Returns (body match, upload) pairs, the match is None for the regular attachments
+    def upload_article_attachments(self, source, inline_only=False):
+        jobs = []
+        for match in set(re.findall(self.IMG_SRC_PATTERN, source.body or '')):
+            url = self.source_attachment_url(match)
+            if url:
+                jobs.append((match, url, True, None, None))
+
+        attachments = [] if inline_only else self.source_client.help_center.attachments(article=source.id)
+        for attachment in attachments:
             if not attachment.inline:
-                url = attachment.content_url
-                file_name = attachment.file_name
-                content_type = attachment.content_type
-                response = requests.get(url, auth=self.source_auth, allow_redirects=False)
-
-                if not response.status_code == 200:
-                    print('- ERROR getting attachment %s: %s' % (url, response.status_code))
-                    continue
-
-                with tempfile.TemporaryFile() as tmp_file:
-                    tmp_file.write(response.content)
-                    tmp_file.seek(0)
-                    upload = self.target_client.help_center.attachments.create(article=article,
-                                                                               attachment=tmp_file,
-                                                                               inline=attachment.inline,
-                                                                               file_name=file_name,
-                                                                               content_type=content_type)
-                    print('- Attachment created - %s' % file_name)
-
-        if changes:
-            print('- Updating translation')
-            self.target_client.help_center.articles.update_translation(article, trans)
+                jobs.append((None, attachment.content_url, False, attachment.file_name, attachment.content_type))
+
+        uploads = []
+        for job, upload, error in self.run_concurrently(self.upload_attachment, jobs):
+            if error:
+                print('- ERROR uploading attachment %s: %s' % (job[1], error))
+            elif upload:
+                uploads.append((job[0], upload))
+
+        return uploads
+
+    # Point the inline images of the body to their uploaded copies
+    def rewrite_body(self, body, uploads):
+        for match, upload in uploads:
+            if match:
+                body = body.replace(match, upload.relative_path)
+        return body
+
+    def associate_attachments(self, article, uploads):
+        attachments = [upload for match, upload in uploads]
+        for chunk in self.chunks(attachments, self.BULK_ATTACHMENTS_LIMIT):
+            self.target_client.help_center.attachments.bulk_attachments(article, chunk)
+        if attachments:
+            print('- %s attachments associated' % len(attachments))
+
+    def upload_attachment(self, job):
+        match, url, inline, file_name, content_type = job
+        if inline:
+            response = self.api_get(url, auth=self.source_auth)
         else:
-            print('- No changes found')
+            response = self.api_get(url, auth=self.source_auth, allow_redirects=False)
+
+        if not response.status_code == 200:
+            print('- ERROR getting attachment %s: %s' % (url, response.status_code))
+            return None
+
+        if inline:
+            content_disp = response.headers.get('content-disposition')
+            file_name = re.search('inline; filename=\"(.*)\"', content_disp).group(1)
+            content_type = response.headers.get('content-type')
+
+        with tempfile.TemporaryFile() as tmp_file:
+            tmp_file.write(response.content)
+            tmp_file.seek(0)
+            upload = self.target_client.help_center.attachments.create_unassociated(attachment=tmp_file,
+                                                                                    inline=inline,
+                                                                                    file_name=file_name,
+                                                                                    content_type=content_type)
+            print('- Attachment created - %s' % file_name)
+
+        return upload
+
+    # Url to download an inline image from, if it is a source attachment that has to be copied
+    def source_attachment_url(self, match):
+        source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
+        if match.startswith(source_domain) or \
+                match.startswith('https://%s' % self.SOURCE_HELPCENTER_DOMAIN):
+            return match
+        elif match.startswith('/attachments'):
+            return 'https://%s.zendesk.com%s' % (self.SOURCE_INSTANCE, match)
+        return None
+
+    # Audit the links and images of the target articles. The distinct urls of all articles are collected first and
+    # probed once each, then the report is written and the broken articles re-migrated when remigrate is set
+    def check_articles(self, start_category_id=None, single=False, remigrate=False):
+        checks = []
+        for source_section, section, category in self.iter_sections(start_category_id, single):
+            self.populate_target_articles(section.get('id'), with_links=True)
+            items = [(article, category.get('name'), section)
+                     for article in self.source_client.help_center.sections.articles(section=source_section)]
+
+            for item, check, error in self.run_concurrently(lambda item: self.collect_article_links(*item), items):
+                if error:
+                    print('ERROR reading article %s - %s: %s' % (item[0].id, item[0].name, error))
+                elif check:
+                    checks.append(check)
+
+        urls = set()
+        for check in checks:
+            for link_type, match in check.get('links'):
+                if self.needs_probe(link_type, match):
+                    urls.add((match, check.get('authenticated')))
+
+        print('*** Probing %s distinct urls from %s articles' % (len(urls), len(checks)))
+        for (url, authenticated), result, error in self.run_concurrently(self.probe_link, urls):
+            if error:
+                self.probe_cache[(url, authenticated)] = error
+
+        with open(self.REPORT_FILE, 'w+', buffering=self.REPORT_BUFFER_SIZE) as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=',',
+                                   quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+            csvwriter.writerow(['category', 'section', 'article', 'type', 'url', 'status'])
+            for check in checks:
+                self.check_article(check, csvwriter, remigrate)
+
+    # Links and image sources of the target article for source, as collected by populate_target_articles
+    def collect_article_links(self, source, category_name, section):
+
+        # Look for existing
+        existing_article = self.target_directory.get(('article', section.get('id'), source.name))
+        if not existing_article:
+            print('Article not found: %s - %s' % (source.id, source.name))
+            return None
+
+        return {'source': source,
+                'category_name': category_name,
+                'section': section,
+                'article_id': existing_article.get('id'),
+                'article_name': existing_article.get('name'),
+                'authenticated': existing_article.get('authenticated'),
+                'links': existing_article.get('links')}
+
+    def article_links(self, body):
+        links = [('ahref', match) for match in re.findall(self.HREF_PATTERN, body)]
+        links.extend([('imgsrc', match) for match in re.findall(self.IMG_SRC_PATTERN, body)])
+        return links
+
+    def needs_probe(self, link_type, match):
+        if self.SOURCE_HELPCENTER_DOMAIN in match:
+            return False
+        return not (link_type == 'imgsrc' and match.startswith('//'))
+
+    # Status code of the url, or the exception raised. HEAD is tried first and GET is used when HEAD is not
+    # answered with a 200 or a redirect. Requests to the same host are limited to HOST_MAX_CONNECTIONS
+    def probe_link(self, item):
+        url, authenticated = item
+        auth = self.target_auth if authenticated else None
+
+        with self.get_host_semaphore(urllib.parse.urlparse(url).netloc):
+            try:
+                response = requests.head(url, allow_redirects=False, auth=auth, timeout=self.PROBE_TIMEOUT)
+                if response.status_code not in (200, 301, 302):
+                    response = requests.get(url, allow_redirects=False, auth=auth, timeout=self.PROBE_TIMEOUT,
+                                            stream=True)
+                    response.close()
+                result = response.status_code
+            except RequestException as e:
+                result = e
+
+        self.probe_cache[item] = result
+        return result
+
+    def get_host_semaphore(self, host):
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.HOST_MAX_CONNECTIONS)
+            return self.host_semaphores[host]
+
+    def check_article(self, check, csvwriter, remigrate=False):
+        source = check.get('source')
+        section = check.get('section')
+        update_article = False
+
+        if check.get('links'):
+            print('URLs for Article: %s - %s' % (check.get('article_id'), check.get('article_name')))
+
+        for link_type, match in check.get('links'):
+            status = 'OK'
+            if self.SOURCE_HELPCENTER_DOMAIN in match:
+                status = 'Points to old help center'
+                if link_type == 'imgsrc':
+                    update_article = True
+            elif link_type == 'imgsrc' and match.startswith('//'):
+                # Weird but probably ok
+                status = 'Probably OK'
+            else:
+                unreachable = False
+                result = self.probe_cache.get((match, check.get('authenticated')))
+                if isinstance(result, Exception):
+                    unreachable = True
+                    status = 'Unreachable - %s' % result
+                elif link_type == 'ahref' and (result == 301 or result == 302):
+                    status = 'Probably OK, redirect %s' % result
+                elif not result == 200:
+                    unreachable = True
+                    status = 'Unreachable - %s' % result
+
+                if unreachable:
+                    if match.startswith('https://%s' % self.SOURCE_INSTANCE) or \
+                            match.startswith('https://%s' % self.TARGET_HELPCENTER_DOMAIN):
+                        update_article = True
+                    elif match.startswith('/attachments'):
+                        update_article = True
+
+            print('- %s: %s' % (status, match))
+            if not status == 'OK':
+                csvwriter.writerow([check.get('category_name'), section.get('name'), check.get('article_name'),
+                                    link_type, match, status])
+
+        if update_article:
+            if remigrate:
+                print('Re-migrating article %s - %s' % (source.name, source.id))
+                article = self.target_client.help_center.articles(id=check.get('article_id'))
+                self.target_client.help_center.articles.archive(article)
+                self.migrate_article(source, section.get('id'), True)
+            else:
+                print('Would re-migrate article %s - %s' % (source.name, source.id))
 
         print('')
-        return article
 
-    def check_article(self, source, category_name, section, remigrate=False):
+    # Update the target copies of the source articles changed since the last sync. The articles come from the
+    # help center incremental export and are skipped when their body hash matches the one stored at the last sync.
+    # The articles that failed are kept in the state and tried again first on the next run
+    def sync(self, initial_start_time=0):
+        if os.path.exists(self.SYNC_STATE_FILE):
+            with open(self.SYNC_STATE_FILE, 'r') as file:
+                state = json.load(file)
+        elif initial_start_time > 0:
+            state = {'start_time': initial_start_time}
+        else:
+            # Without a start time or stored hashes every article of the source would be rewritten
+            print('ERROR - No %s found, pass the time of the initial migration as the start time' %
+                  self.SYNC_STATE_FILE)
+            return
+        state.setdefault('articles', {})
+        state.setdefault('targets', {})
+        state.setdefault('failed', {})
 
-        # Look for existing
-        article = None
-        for existing_article in self.target_articles.get(section.id):
-            if source.name == existing_article.name and existing_article.section_id == section.id:
-                article = existing_article
-                break
+        self.populate_target_categories()
 
-        if not article:
-            print('Article not found')
+        counts = {'changed': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+        if state.get('failed'):
+            print('Retrying %s articles that failed to sync' % len(state.get('failed')))
+            for source_json in list(state.get('failed').values()):
+                self.sync_changed_article(source_json, state, counts)
+            self.save_sync_state(state)
+
+        print('Syncing articles changed since %s' % state.get('start_time'))
+        path = '/api/v2/help_center/incremental/articles.json?start_time=%s' % state.get('start_time')
+        for page in self.get_incremental_pages_from_api(self.SOURCE_INSTANCE, path, self.source_auth):
+            for source_json in page.get('articles', []):
+                self.sync_changed_article(source_json, state, counts)
+
+            state['start_time'] = page.get('end_time') or state.get('start_time')
+            self.save_sync_state(state)
+            print('*** %s articles synced, %s unchanged, %s skipped, %s failed' %
+                  (counts['changed'], counts['unchanged'], counts['skipped'], counts['failed']))
+
+        if state.get('failed'):
+            print('WARN - %s articles failed to sync and will be retried on the next run: %s' %
+                  (len(state.get('failed')), ', '.join(state.get('failed'))))
+
+    def sync_changed_article(self, source_json, state, counts):
+        article_id = str(source_json.get('id'))
+        body_hash = self.body_hash(source_json.get('body') or '')
+        if state.get('articles').get(article_id) == body_hash:
+            state.get('failed').pop(article_id, None)
+            counts['unchanged'] += 1
             return
 
-        article_body = article.body
-
-        if article_body:
-
-            user_segment = article.user_segment_id
-            auth = self.target_auth if user_segment else None
-
-            update_article = False
-
-            matches = re.findall(self.HREF_PATTERN, article_body)
-            if len(matches) > 0:
-                print('Link URLs for Article: %s - %s' % (article.id, article.name))
-                for match in matches:
-                    status = 'OK'
-                    if self.SOURCE_HELPCENTER_DOMAIN in match:
-                        status = 'Points to old help center'
-                    else:
-                        unreachable = False
-                        try:
-                            result = requests.get(match, allow_redirects=False, auth=auth)
-                            if result.status_code == 301 or result.status_code == 302:
-                                status = 'Probably OK, redirect %s' % result.status_code
-                            elif not result.status_code == 200:
-                                unreachable = True
-                                status = 'Unreachable - %s' % result.status_code
-                        except RequestException as e:
-                            unreachable = True
-                            status = 'Unreachable - %s' % e
-
-                        if unreachable:
-                            if match.startswith('https://%s' % self.SOURCE_INSTANCE) or \
-                                    match.startswith('https://%s' % self.TARGET_HELPCENTER_DOMAIN):
-                                update_article = True
-                            elif match.startswith('/attachments'):
-                                update_article = True
-
-                    print('- %s: %s' % (status, match))
-                    if not status == 'OK':
-                        with open(self.REPORT_FILE, 'a') as csvfile:
-                            csvwriter = csv.writer(csvfile, delimiter=',',
-                                                   quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                            csvwriter.writerow([category_name, section.name, article.name, 'ahref', match, status])
-
-            matches = re.findall(self.IMG_SRC_PATTERN, article_body)
-            if len(matches) > 0:
-                print('Image Source URLs for Article: %s - %s' % (article.id, article.name))
-
-                for match in matches:
-                    status = 'OK'
-                    if self.SOURCE_HELPCENTER_DOMAIN in match:
-                        status = 'Points to old help center'
-                        update_article = True
-                    else:
-                        unreachable = False
-                        if match.startswith('//'):
-                            # Weird but probably ok
-                            status = 'Probably OK'
-                        else:
-                            try:
-                                result = requests.get(match, allow_redirects=False, auth=auth)
-                                if not result.status_code == 200:
-                                    unreachable = True
-                                    status = 'Unreachable - %s' % result.status_code
-                            except RequestException as e:
-                                unreachable = True
-                                status = 'Unreachable - %s' % e
-
-                        if unreachable:
-                            if match.startswith('https://%s' % self.SOURCE_INSTANCE) or \
-                                    match.startswith('https://%s' % self.TARGET_HELPCENTER_DOMAIN):
-                                update_article = True
-                            elif match.startswith('/attachments'):
-                                update_article = True
-
-                    print('- %s: %s' % (status, match))
-                    if not status == 'OK':
-                        with open(self.REPORT_FILE, 'a') as csvfile:
-                            csvwriter = csv.writer(csvfile, delimiter=',',
-                                                   quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                            csvwriter.writerow([category_name, section.name, article.name, 'imgsrc', match, status])
-
-            if update_article:
-                if remigrate:
-                    print('Re-migrating article %s - %s' % (source.name, source.id))
-                    self.target_client.help_center.articles.archive(article)
-                    self.migrate_article(source, section.id, True)
-                else:
-                    print('Would re-migrate article %s - %s' % (source.name, source.id))
+        try:
+            synced = self.sync_article(source_json, state.get('targets'))
+        except Exception as e:
+            print('ERROR - Unable to sync article %s - %s: %s' % (article_id, source_json.get('title'), e))
+            state.get('failed')[article_id] = source_json
+            counts['failed'] += 1
+            return
 
-            print('')
+        state.get('failed').pop(article_id, None)
+        if synced:
+            state.get('articles')[article_id] = body_hash
+            counts['changed'] += 1
+        else:
+            counts['skipped'] += 1
+
+    def save_sync_state(self, state):
+        tmp_file = self.SYNC_STATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmp_file, self.SYNC_STATE_FILE)
+
+    # Bring the target copy of a changed source article up to date. The target is found by the source -> target
+    # id recorded in targets, so renamed articles are not copied again, and by name for the articles migrated
+    # before the first sync. New inline images are uploaded and the translation is updated in place. Returns
+    # False when it was skipped
+    def sync_article(self, source_json, targets):
+        if source_json.get('locale') and not source_json.get('locale') == 'en-us':
+            return False
+
+        source_id = str(source_json.get('id'))
+        article = None
+        if source_id in targets:
+            try:
+                article = self.target_client.help_center.articles(id=targets.get(source_id))
+            except RecordNotFoundException:
+                print('WARN - Target article %s of %s was deleted' % (targets.get(source_id), source_id))
+
+        source = self.source_client.help_center.articles(id=source_json.get('id'))
+        if article is None:
+            section = self.get_sync_section(source_json)
+            if not section:
+                return False
+
+            existing_article = self.target_directory.get(('article', section.get('id'), source.name))
+            if not existing_article:
+                targets[source_id] = self.migrate_article(source, section.get('id')).get('id')
+                return True
+
+            article = self.target_client.help_center.articles(id=existing_article.get('id'))
+
+        # Update in place so the article keeps its id and the links to it
+        print('Updating translation for article %s - %s' % (source.id, source.name))
+        targets[source_id] = article.id
+        uploads = self.upload_article_attachments(source, inline_only=True)
+        body = self.rewrite_body(source.body or '', uploads)
+        self.associate_attachments(article, uploads)
+        trans = Translation(title=source.title, body=body, draft=bool(source.draft), locale='en-us')
+        self.target_client.help_center.articles.update_translation(article, trans)
+
+        return True
+
+    # The target section of a source article, created with its category when missing
+    def get_sync_section(self, source_json):
+        source_section = self.get_source_section(source_json.get('section_id'))
+        if not source_section:
+            print('WARN - Section %s not found for article %s' % (source_json.get('section_id'), source_json.get('id')))
+            return None
+
+        source_category = self.source_client.help_center.categories(id=source_section.category_id)
+        category = self.get_target_category(source_category)
+        if ('section', category.get('id'), source_section.name) not in self.target_directory:
+            self.populate_target_sections(category.get('id'))
+        section = self.get_target_section(source_section, category)
+        if section.get('id') not in self.synced_sections:
+            self.populate_target_articles(section.get('id'))
+            self.synced_sections.add(section.get('id'))
+
+        return section
+
+    def get_source_section(self, section_id):
+        if section_id not in self.source_section_cache:
+            section = None
+            for source_section in self.source_client.help_center.sections():
+                self.source_section_cache[source_section.id] = source_section
+                if source_section.id == section_id:
+                    section = source_section
+            self.source_section_cache[section_id] = section
+
+        return self.source_section_cache.get(section_id)
 
     def update_article_links(self, start_category_id, single):
         # Categories
@@ -355,17 +596,9 @@ class HelpcenterMigration(BaseMigration):
         # Look for the old style urls first
         matches = re.findall(self.OLD_URL_PATTERN, content)
         for match in matches:
-            try:
-                source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
-                source_alt_domain = '%s.zendesk.com' % self.SOURCE_ALT_INSTANCE
-                url = match.replace(source_alt_domain, source_domain)
-
-                response = requests.get(url, auth=self.source_auth, allow_redirects=False)
-                if response.status_code == 301 or response.status_code == 302:
-                    url = response.headers.get('location')
-                    content = content.replace(match, url)
-            except RequestException as e:
-                pass
+            url = self.get_redirect(match)
+            if url:
+                content = content.replace(match, url)
 
         matches = re.findall(self.URL_PATTERN, content)
         for match in matches:
@@ -377,36 +610,12 @@ class HelpcenterMigration(BaseMigration):
 
             source_item_id = re.findall('.*/(\d+)', url)[0]
 
-            try:
-                new_id = None
-                if item == 'articles':
-                    # Get the old article
-                    source_article = self.source_client.help_center.articles(id=source_item_id)
-                    article_name = source_article.title
-
-                    # Search for the corresponding article in the new site
-                    new_id = self.find_article_for_name(article_name)
-                elif item == 'sections':
-                    source_section = self.source_client.help_center.sections(id=source_item_id)
-                    section_name = source_section.name
-
-                    # Search for the corresponding article in the new site
-                    new_id = self.find_section_for_name(section_name)
-                elif item == 'categories':
-                    source_category = self.source_client.help_center.categories(id=source_item_id)
-                    category_name = source_category.name
-
-                    # Search for the corresponding article in the new site
-                    new_id = self.find_category_for_name(category_name)
-
-                if new_id:
-                    # Search/replace the link
-                    new_url = '/hc/en-us/%s/%s' % (item, new_id)
-                    print('- New URL: %s' % new_url)
-                    content = content.replace(url, new_url)
-                    changes = True
-            except RecordNotFoundException as e:
-                print('- Record not found, probably migrated already')
+            new_url = self.resolve_link(item, source_item_id)
+            if new_url:
+                # Search/replace the link
+                print('- New URL: %s' % new_url)
+                content = content.replace(url, new_url)
+                changes = True
 
         if changes:
             print('- Updating article')
@@ -415,55 +624,156 @@ class HelpcenterMigration(BaseMigration):
         else:
             print('- No changes found')
 
-    def find_article_for_name(self, name):
-        article_id = None
-        for article in self.target_client.help_center.articles.search(query=name):
-            if article.title == name:
-                article_id = article.id
-                break
+    # Redirect location of an old style url, memoized including the urls that do not redirect
+    def get_redirect(self, match):
+        if match not in self.redirect_cache:
+            location = None
+            try:
+                source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
+                source_alt_domain = '%s.zendesk.com' % self.SOURCE_ALT_INSTANCE
+                url = match.replace(source_alt_domain, source_domain)
 
-        return article_id
+                response = self.api_get(url, auth=self.source_auth, allow_redirects=False)
+                if response.status_code == 301 or response.status_code == 302:
+                    location = response.headers.get('location')
+            except RequestException as e:
+                pass
 
-    def find_section_for_name(self, name):
-        section_id = None
-        for section in self.target_client.help_center.sections():
-            if section.name == name:
-                section_id = section.id
-                break
+            self.redirect_cache[match] = location
 
-        return section_id
+        return self.redirect_cache.get(match)
 
-    def find_category_for_name(self, name):
-        category_id = None
-        for category in self.target_client.help_center.categories():
-            if category.name == name:
-                category_id = category.id
-                break
+    # Target url for a source article, section or category link, memoized including the failures
+    def resolve_link(self, item, source_item_id):
+        key = (item, str(source_item_id))
+        if key not in self.link_cache:
+            self.populate_link_maps()
+
+            new_url = None
+            name = self.source_link_names.get(item).get(str(source_item_id))
+            if name is None:
+                print('- Record not found, probably migrated already')
+            else:
+                # Look up the corresponding item in the new site
+                new_id = self.target_link_ids.get(item).get(name)
+                if new_id:
+                    new_url = '/hc/en-us/%s/%s' % (item, new_id)
+
+            self.link_cache[key] = new_url
 
-        return category_id
+        return self.link_cache.get(key)
+
+    # Source id -> title and target title -> id for articles, sections and categories, built once per run
+    def populate_link_maps(self):
+        if self.source_link_names is not None:
+            return
+
+        print('Loading source and target help center titles')
+        self.source_link_names = {'articles': {}, 'sections': {}, 'categories': {}}
+        self.target_link_ids = {'articles': {}, 'sections': {}, 'categories': {}}
+
+        for article in self.source_client.help_center.articles():
+            self.source_link_names['articles'][str(article.id)] = article.title
+        for section in self.source_client.help_center.sections():
+            self.source_link_names['sections'][str(section.id)] = section.name
+        for category in self.source_client.help_center.categories():
+            self.source_link_names['categories'][str(category.id)] = category.name
+
+        for article in self.target_client.help_center.articles():
+            self.target_link_ids['articles'].setdefault(article.title, article.id)
+        for section in self.target_client.help_center.sections():
+            self.target_link_ids['sections'].setdefault(section.name, section.id)
+        for category in self.target_client.help_center.categories():
+            self.target_link_ids['categories'].setdefault(category.name, category.id)
 
     def populate_target_categories(self):
         for category in self.target_client.help_center.categories():
-            self.target_categories.append(category)
+            self.add_to_directory('category', None, category)
 
     def populate_target_sections(self, category_id):
-        sections = []
         for section in self.target_client.help_center.sections(category_id=category_id):
-            sections.append(section)
-
-        self.target_sections[category_id] = sections
+            self.add_to_directory('section', category_id, section)
 
-    def populate_target_articles(self, section_id):
-        articles = []
+    # with_links keeps the links of the bodies for check_articles, so the articles are not fetched again
+    def populate_target_articles(self, section_id, with_links=False):
         for article in self.target_client.help_center.articles(section_id=section_id):
-            articles.append(article)
-
-        self.target_articles[section_id] = articles
+            entry = self.add_to_directory('article', section_id, article)
+            if with_links:
+                entry['links'] = self.article_links(article.body or '')
+                entry['authenticated'] = bool(article.user_segment_id)
+
+    def add_to_directory(self, entity_type, parent_id, entity):
+        entry = {'id': entity.id, 'name': entity.name}
+        self.target_directory[(entity_type, parent_id, entity.name)] = entry
+        return entry
+
+    def body_hash(self, body):
+        return hashlib.md5(body.encode('utf-8')).hexdigest()
+
+    # Delete the articles, then the sections from the deepest level up, then the emptied categories, each on the
+    # worker pool. Deleting a parent first would leave its children to fail with a 404 once the delete cascades.
+    # A 404 is still counted as already deleted. With dry_run only the categories, sections and articles that
+    # would be deleted are counted
+    def purge_target(self, dry_run=False):
+        category_ids = [category.id for category in self.target_client.help_center.categories()]
+        parent_ids = dict((section.id, getattr(section, 'parent_section_id', None))
+                          for section in self.target_client.help_center.sections())
+
+        if dry_run:
+            article_count = sum(1 for article in self.target_client.help_center.articles())
+            print('Would delete %s categories, %s sections and %s articles' %
+                  (len(category_ids), len(parent_ids), article_count))
+            return
 
-    def purge_target(self):
-        for category in self.target_client.help_center.categories():
-            print('Deleting category %s - %s' % (category.id, category.name))
-            self.target_client.help_center.categories.delete(category)
+        article_ids = [article.id for article in self.target_client.help_center.articles()]
+        failures = self.purge_entities('articles', article_ids)
+
+        levels = {}
+        for section_id in parent_ids:
+            depth = 0
+            parent_id = parent_ids.get(section_id)
+            while parent_id and depth < len(parent_ids):
+                depth += 1
+                parent_id = parent_ids.get(parent_id)
+            levels.setdefault(depth, []).append(section_id)
+
+        for depth in sorted(levels, reverse=True):
+            failures += self.purge_entities('sections', levels.get(depth))
+
+        failures += self.purge_entities('categories', category_ids)
+        print('Purge done, %s failures' % failures)
+
+    def purge_entities(self, entity_name, entity_ids):
+        print('Deleting %s %s' % (len(entity_ids), entity_name))
+
+        # True when deleted, None when already gone
+        def delete_entity(entity_id):
+            url = self.URL % (self.TARGET_INSTANCE, '/api/v2/help_center/%s/%s.json' % (entity_name, entity_id))
+            response = self.api_request(requests.delete, url, auth=self.target_auth)
+            if response.status_code == 404:
+                return None
+            if not response.status_code == 204:
+                raise Exception('status=%s: %s' % (response.status_code, response.content))
+            return True
+
+        start = time.time()
+        counter = 0
+        failures = 0
+        gone = 0
+        for entity_id, success, error in self.run_concurrently(delete_entity, entity_ids):
+            if error:
+                print('ERROR - Unable to delete %s %s: %s' % (entity_name, entity_id, error))
+                failures += 1
+            elif success is None:
+                gone += 1
+
+            counter += 1
+            if counter % 10 == 0 or counter == len(entity_ids):
+                elapsed = time.time() - start
+                print('*** Deleted %s of %s %s (%.1f/sec), %s already deleted, %s failures' %
+                      (counter, len(entity_ids), entity_name, counter / elapsed, gone, failures))
+
+        return failures
 
     def get_target_user_segment(self, source_id):
         segment_id = self.user_segment_cache.get(source_id)
@@ -488,12 +798,17 @@ if __name__ == '__main__':
     if action_arg == 'migrate' or action_arg == 'check' or action_arg == 'check_and_update':
         start_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
         single_run = (sys.argv[3] == '1') if len(sys.argv) > 3 else None
-        helpcenter_migration.main(start_id, single_run, action_arg)
+        parallel_run = (sys.argv[4] == '1') if len(sys.argv) > 4 else False
+        helpcenter_migration.main(start_id, single_run, action_arg, parallel_run)
     elif action_arg == 'update_links':
         start_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
         single_run = (sys.argv[3] == '1') if len(sys.argv) > 3 else None
         helpcenter_migration.update_article_links(start_id, single_run)
+    elif action_arg == 'sync':
+        start_time_arg = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+        helpcenter_migration.sync(start_time_arg)
     elif action_arg == 'purge':
-        helpcenter_migration.purge_target()
+        dry_run_arg = (sys.argv[2] == '1') if len(sys.argv) > 2 else False
+        helpcenter_migration.purge_target(dry_run_arg)
 
     sys.exit()
@@ -3,12 +3,19 @@
 """
 Produces a CSV based on the JSON input
 
+The second argument is the input type, 'normal' for a JSON document or 'line' for one JSON object per line.
+Line input is streamed in two passes, the first collects the header and the second writes the rows, so
+memory use does not depend on the size of the file.
+
 """
 
 import csv
 import sys
 import json
 
+PROGRESS_INTERVAL = 10000
+WRITE_BUFFER_SIZE = 1024 * 1024
+
 
 def create_csv_from_file(args):
     json_filename = args[0]
@@ -17,84 +24,114 @@ def create_csv_from_file(args):
     if len(args) >= 2:
         json_type = args[1]
 
-    with open(json_filename) as json_file:
-        json_data = None
-        if json_type == 'normal':
+    if json_type == 'line':
+        create_csv_from_lines(json_filename, json_filename)
+    else:
+        with open(json_filename) as json_file:
             json_data = json.load(json_file)
-        elif json_type == 'line':
-            json_data = []
-            cnt = 1
-            for line in json_file:
-                print('Loading line %s' % cnt)
-                json_data.append(json.loads(line))
-                cnt += 1
 
-        if json_data:
-            create_csv(json_data, json_filename)
+            if json_data:
+                create_csv(json_data, json_filename)
 
 
-def create_csv(json_data, output_filename):
-    with open(output_filename + '.csv', 'w') as csvfile:
+def create_csv_from_lines(json_filename, output_filename):
+    # First pass - the header is the union of the keys of every line
+    header = []
+    seen_keys = set()
+    with open(json_filename) as json_file:
+        cnt = 0
+        for line in json_file:
+            if not line.strip():
+                continue
+
+            for key in get_header(json.loads(line)):
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    header.append(key)
+
+            cnt += 1
+            if cnt % PROGRESS_INTERVAL == 0:
+                print('Scanned %s lines' % cnt)
+
+    # Second pass - write the rows
+    with open(json_filename) as json_file, \
+            open(output_filename + '.csv', 'w', buffering=WRITE_BUFFER_SIZE) as csvfile:
         csvwriter = csv.writer(csvfile, delimiter=',',
                                quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        csvwriter.writerow(header)
 
-        if isinstance(json_data, dict):
-            header = []
-            for key in json_data.keys():
-                value = json_data.get(key)
-                if isinstance(value, dict):
-                    for sub_key in value.keys():
-                        header.append(key + '.' + sub_key)
-                else:
-                    header.append(key)
+        cnt = 0
+        for line in json_file:
+            if not line.strip():
+                continue
 
-            csvwriter.writerow(header)
+            csvwriter.writerow(get_row(json.loads(line), header))
+
+            cnt += 1
+            if cnt % PROGRESS_INTERVAL == 0:
+                print('Wrote %s rows' % cnt)
+
+        print('Wrote %s rows to %s.csv' % (cnt, output_filename))
 
-            row = []
-            for key in header:
-                value = get_value(json_data, key)
-                if isinstance(value, dict):
-                    for sub_val in value.values():
-                        row.append(sub_val)
-                else:
-                    row.append(value)
 
-            csvwriter.writerow(row)
+def create_csv(json_data, output_filename):
+    with open(output_filename + '.csv', 'w', buffering=WRITE_BUFFER_SIZE) as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=',',
+                               quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+
+        if isinstance(json_data, dict):
+            header = get_header(json_data)
+            csvwriter.writerow(header)
+            csvwriter.writerow(get_row(json_data, header))
 
         elif isinstance(json_data, list):
             header = []
-            for key in json_data[0].keys():
-                value = json_data[0].get(key)
-                if isinstance(value, dict):
-                    for sub_key in value.keys():
-                        header.append(key + '.' + sub_key)
-                else:
-                    header.append(key)
+            seen_keys = set()
+            for element in json_data:
+                for key in get_header(element):
+                    if key not in seen_keys:
+                        seen_keys.add(key)
+                        header.append(key)
 
             csvwriter.writerow(header)
 
-            cnt = 1
+            cnt = 0
             for element in json_data:
-                row = []
-                for key in header:
-                    value = get_value(element, key)
-                    if isinstance(value, dict):
-                        for sub_val in value.values():
-                            row.append(sub_val)
-                    else:
-                        row.append(value)
-
-                print('Writing row %s' % cnt)
+                csvwriter.writerow(get_row(element, header))
+
                 cnt += 1
-                csvwriter.writerow(row)
+                if cnt % PROGRESS_INTERVAL == 0:
+                    print('Wrote %s rows' % cnt)
+
+
+# Header keys for an element, nested objects are flattened to key.sub_key
+def get_header(json_data):
+    header = []
+    for key in json_data.keys():
+        value = json_data.get(key)
+        if isinstance(value, dict):
+            for sub_key in value.keys():
+                header.append(key + '.' + sub_key)
+        else:
+            header.append(key)
+
+    return header
+
+
+def get_row(json_data, header):
+    row = []
+    for key in header:
+        row.append(get_value(json_data, key))
+
+    return row
 
 
 def get_value(json_data, key):
     value = None
     if '.' in key:
-        keys = str(key).split('.')
+        keys = str(key).split('.', 1)
         top_val = json_data.get(keys[0])
-        if top_val is not None:
+        if isinstance(top_val, dict):
             value = top_val.get(keys[1])
     else:
         value = json_data.get(key)
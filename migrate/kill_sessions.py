@@ -3,32 +3,77 @@
 """
 Deletes all sessions
 
+The sessions are grouped by user and deleted with the bulk delete endpoint for each user, using a pool of
+concurrent workers. Users whose sessions could not be deleted are written to kill_sessions_failures.txt,
+pass that file as the first argument to retry them.
+
 """
 import sys
+import time
 
 from base_zendesk import BaseZendesk
 
 
 class SessionKill(BaseZendesk):
 
-    def main(self):
+    FAILURES_FILE = 'kill_sessions_failures.txt'
+
+    def main(self, retry_filename=None):
+
+        if retry_filename:
+            user_ids = self.read_user_ids(retry_filename)
+        else:
+            user_ids = self.get_session_user_ids()
 
-        sessions = self.get_list_from_api(instance=self.SOURCE_INSTANCE,
-                                          path='/api/v2/sessions.json',
-                                          auth=self.source_auth,
-                                          entity_name='sessions')
+        start = time.time()
         counter = 0
-        for session in sessions:
-            url = '/api/v2/users/%s/sessions/%s.json' % (session.get('user_id'), session.get('id'))
-            self.delete_at_api(instance=self.SOURCE_INSTANCE,
-                               path=url,
-                               auth=self.source_auth)
-            print('Deleted session %s' % session.get('id'))
+        failures = []
+        for user_id, success, error in self.run_concurrently(self.delete_user_sessions, user_ids):
+            if error or not success:
+                print('ERROR - Unable to delete sessions for user %s: %s' % (user_id, error))
+                failures.append(user_id)
+
             counter += 1
+            if counter % 100 == 0:
+                elapsed = time.time() - start
+                print('*** Deleted sessions for %s of %s users (%.1f users/sec), %s failures' %
+                      (counter, len(user_ids), counter / elapsed, len(failures)))
+
+        with open(self.FAILURES_FILE, 'w') as file:
+            for user_id in failures:
+                file.write('%s\n' % user_id)
 
-        print('Deleted %s sessions' % counter)
+        print('Deleted sessions for %s users in %s sec, %s failures written to %s' %
+              (counter - len(failures), (time.time() - start), len(failures), self.FAILURES_FILE))
+
+    # Collect the users with sessions before deleting anything, deleting while paging would shift the pages
+    def get_session_user_ids(self):
+        user_ids = []
+        seen = set()
+        for session in self.iter_list_from_api(instance=self.SOURCE_INSTANCE,
+                                               path='/api/v2/sessions.json',
+                                               auth=self.source_auth,
+                                               entity_name='sessions'):
+            user_id = session.get('user_id')
+            if user_id not in seen:
+                seen.add(user_id)
+                user_ids.append(user_id)
+
+        print('Found sessions for %s users' % len(user_ids))
+        return user_ids
+
+    def read_user_ids(self, filename):
+        with open(filename, 'r') as file:
+            return [line.strip() for line in file if line.strip()]
+
+    def delete_user_sessions(self, user_id):
+        return self.delete_at_api(instance=self.SOURCE_INSTANCE,
+                                  path='/api/v2/users/%s/sessions.json' % user_id,
+                                  auth=self.source_auth)
 
 
 if __name__ == '__main__':
+    filename_arg = sys.argv[1] if len(sys.argv) > 1 else None
+
     session_kill = SessionKill()
-    sys.exit(session_kill.main())
+    sys.exit(session_kill.main(filename_arg))
@@ -12,22 +12,26 @@ class MacroMigration(BaseMigration):
 
         if macro_id:
             source = self.source_client.macros(id=macro_id)
+            self.prepare_rule_translation([source])
             self.migrate_macro(source)
         else:
-            for source in self.source_client.macros():
+            sources = list(self.source_client.macros())
+            self.prepare_rule_translation([source for source in sources if source.active])
+            for source in sources:
                 self.migrate_macro(source)
 
                 # if source.active:
                 #     print(source.title + ': ' + str(source.actions))
 
+        self.print_unresolved_references()
+
     def migrate_macro(self, source):
         if source.active:
 
-            for existing in self.target_client.macros():
-                source_title = 'MIGRATED ' + source.title
-                if source_title == existing.title:
-                    print('Existing macro found for %s' % source.title)
-                    return
+            title_index = self.get_target_title_index('macros', self.target_client.macros)
+            if 'MIGRATED ' + source.title in title_index:
+                print('Existing macro found for %s' % source.title)
+                return
 
             print('Migrating macro %s' % source.title)
             macro = Macro(title='MIGRATED ' + source.title,
@@ -58,7 +62,8 @@ class MacroMigration(BaseMigration):
                     macro.restriction['ids'] = ids
 
             try:
-                self.target_client.macros.create(macro)
+                created = self.target_client.macros.create(macro)
+                title_index[macro.title] = getattr(created, 'id', None)
                 print('Created macro %s' % macro.title)
             except APIException as ae:
                 print('ERROR - APIException: %s' % ae)
@@ -1,48 +1,96 @@
 #!/usr/bin/env python
 
 """
-Produces a CSV with a list of all Organizations in ZenDesk
+Imports the organization fields from organizations.csv into the matching organizations in ZenDesk.
+The organizations are updated in batches with update_many jobs and the outcome for each row
+is written to organizations-import-result.csv
 
 """
 import csv
 import sys
-import urllib.parse
+
+from zenpy.lib.api_objects import Organization
 
 from base_zendesk import BaseZendesk
 
 
 class OrganizationImport(BaseZendesk):
 
+    RESULT_FILE = 'organizations-import-result.csv'
+
     def main(self):
 
-        with open('organizations.csv', 'r') as csvfile:
+        org_index = dict((org.name, org.id) for org in self.iter_target_orgs())
+
+        with open('organizations.csv', 'r') as csvfile, open(self.RESULT_FILE, 'w') as resultfile:
             csvreader = csv.reader(csvfile, delimiter=',',
                                    quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+            resultwriter = csv.writer(resultfile, delimiter=',',
+                                      quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+            resultwriter.writerow(['name', 'id', 'status'])
 
             header = None
+            batch = []
+            submitted = {}
+            jobs = []
             for row in csvreader:
                 name = row[0]
                 if not header:
                     header = row
                     continue
 
-                search_name = urllib.parse.quote(name)
-                org = None
-                for search_org in self.target_client.search(type='organization', name=search_name):
-                    if search_org.name == name:
-                        print('Organization found for %s' % name)
-                        org = search_org
-                        break
-
-                if org:
+                org_id = org_index.get(name)
+                if org_id:
+                    fields = {}
                     for i in range(len(header) - 1):
                         i += 1
-                        org.organization_fields[header[i]] = str(row[i])
+                        fields[header[i]] = str(row[i])
 
-                    print('Updating org %s' % name)
-                    self.target_client.organizations.update(org)
+                    batch.append((name, Organization(id=org_id, organization_fields=fields)))
                 else:
                     print('WARN - Organization not found for %s' % name)
+                    resultwriter.writerow([name, '', 'Not found'])
+
+                if len(batch) >= self.SHOW_MANY_LIMIT:
+                    self.submit_updates(batch, submitted, jobs, resultwriter)
+                    batch = []
+
+            self.submit_updates(batch, submitted, jobs, resultwriter, wait=True)
+
+    def submit_updates(self, batch, submitted, jobs, resultwriter, wait=False):
+        if len(batch) > 0:
+            print('Updating %s orgs' % len(batch))
+            job = self.target_client.organizations.update([org for (name, org) in batch])
+            submitted[job.id] = batch
+            jobs.append(job)
+
+        # Bound the number of jobs queued at once
+        if len(jobs) > 0 and (wait or len(jobs) >= self.MAX_QUEUED_JOBS):
+            for finished in self.wait_for_jobs(self.target_client, jobs):
+                self.write_results(finished, submitted.pop(finished.id), resultwriter)
+            del jobs[:]
+
+    def write_results(self, job, batch, resultwriter):
+        reported = set()
+        for position, result in enumerate(job.results or []):
+            if getattr(result, 'index', None) is not None:
+                position = result.index
+            if position >= len(batch):
+                continue
+
+            reported.add(position)
+            name, org = batch[position]
+            error = getattr(result, 'error', None) or getattr(result, 'errors', None)
+            if error:
+                resultwriter.writerow([name, org.id, 'Error - %s %s' % (error, getattr(result, 'details', ''))])
+            else:
+                resultwriter.writerow([name, org.id, 'Updated'])
+
+        # A failed or killed job can finish without results for some or all of its orgs
+        for position, (name, org) in enumerate(batch):
+            if position not in reported:
+                resultwriter.writerow([name, org.id, 'Error - job %s %s %s' % (job.id, job.status,
+                                                                             getattr(job, 'message', None) or '')])
 
 
 if __name__ == '__main__':
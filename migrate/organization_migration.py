@@ -9,12 +9,14 @@ from base_migration import BaseMigration
 
 class OrganizationMigration(BaseMigration):
 
-    def main(self, org_id=None, update=True):
+    def main(self, org_id=None, update=True, bulk=False):
         start = time.time()
 
         if org_id:
             source = self.source_client.organizations(id=org_id)
             self.migrate_org(source, update)
+        elif bulk:
+            self.migrate_orgs_bulk(update)
         else:
             for source in self.source_client.organizations():
                 self.migrate_org(source, update)
@@ -32,46 +34,129 @@ class OrganizationMigration(BaseMigration):
                 print('- Skippig - Org already migrated')
             else:
                 if update:
-                    existing.domain_names.extend(source.domain_names)
-                    existing.tags.extend(source.tags)
-
-                    if existing.details and source.details:
-                            existing.details = existing.details + '\n' + source.details
-                    elif not existing.details:
-                        existing.details = source.details
-
-                    if existing.notes and source.notes:
-                            existing.notes = existing.notes + '\n' + source.notes
-                    elif not existing.notes:
-                        existing.notes = source.notes
-
-                    existing.organization_fields['migrated'] = True
-
                     try:
-                        self.target_client.organizations.update(existing)
+                        self.target_client.organizations.update(self.merge_org(existing, source))
                         print('- Org updated')
                     except APIException as ae:
                         print('***ERROR*** updating org - APIException: %s' % ae)
                 else:
                     print('- Skipping - Org exists and update is false')
         else:
-            org = Organization(name=source.name,
-                               shared_tickets=source.shared_tickets,
-                               shared_comments=source.shared_comments,
-                               external_id=source.external_id,
-                               domain_names=source.domain_names,
-                               details=source.details,
-                               notes=source.notes,
-                               group_id=source.group_id,
-                               tags=source.tags,
-                               organization_fields={'migrated': True})
-
             try:
-                self.target_client.organizations.create(org)
+                self.target_client.organizations.create(self.new_org(source))
                 print('- Org created')
             except APIException as ae:
                 print('***ERROR*** creating org - APIException: %s' % ae)
 
+    # Load every target org once and send the creates and merges as create_many/update_many jobs
+    def migrate_orgs_bulk(self, update=True):
+        target_orgs = dict((org.name, org) for org in self.iter_target_orgs())
+
+        creates = []
+        updates = []
+        # Target org id -> position in updates, several source orgs can map to the same target org
+        update_positions = {}
+        for source in self.source_client.organizations():
+            existing = target_orgs.get(source.name)
+            if existing is None:
+                creates.append((source, self.new_org(source)))
+                # Guard against duplicate names in the source
+                target_orgs[source.name] = Organization(name=source.name, organization_fields={'migrated': True})
+            elif existing.organization_fields.get('migrated'):
+                print('Skipping %s - %s - Org already migrated' % (source.id, source.name))
+            elif update and existing.id in update_positions:
+                # Merge into the pending update, two update_many entries for one org would conflict
+                position = update_positions.get(existing.id)
+                first_source, merged = updates[position]
+                updates[position] = (first_source, self.merge_org(merged, source))
+                print('Merging %s - %s into the update of org %s' % (source.id, source.name, existing.id))
+            elif update:
+                update_positions[existing.id] = len(updates)
+                updates.append((source, self.merge_org(existing, source)))
+            else:
+                print('Skipping %s - %s - Org exists and update is false' % (source.id, source.name))
+
+        print('Creating %s orgs and updating %s orgs' % (len(creates), len(updates)))
+
+        submitted = {}
+        jobs = []
+        for (action, changes, func) in (('created', creates, self.target_client.organizations.create),
+                                        ('updated', updates, self.target_client.organizations.update)):
+            for chunk in self.chunks(changes, self.SHOW_MANY_LIMIT):
+                try:
+                    job = func([org for (source, org) in chunk])
+                    submitted[job.id] = (action, chunk)
+                    jobs.append(job)
+                except APIException as ae:
+                    print('***ERROR*** submitting org job - APIException: %s' % ae)
+
+                if len(jobs) >= self.MAX_QUEUED_JOBS:
+                    self.report_org_jobs(self.wait_for_jobs(self.target_client, jobs), submitted)
+                    jobs = []
+
+        self.report_org_jobs(self.wait_for_jobs(self.target_client, jobs), submitted)
+
+    def report_org_jobs(self, finished_jobs, submitted):
+        for job in finished_jobs:
+            action, chunk = submitted.get(job.id)
+            for position, result in enumerate(job.results or []):
+                if getattr(result, 'index', None) is not None:
+                    position = result.index
+                source = chunk[position][0] if position < len(chunk) else None
+                name = '%s - %s' % (source.id, source.name) if source else getattr(result, 'id', None)
+
+                error = getattr(result, 'error', None) or getattr(result, 'errors', None)
+                if error:
+                    print('***ERROR*** org %s not %s: %s %s' % (name, action, error, getattr(result, 'details', '')))
+                else:
+                    print('Org %s %s' % (name, action))
+
+    def new_org(self, source):
+        return Organization(name=source.name,
+                            shared_tickets=source.shared_tickets,
+                            shared_comments=source.shared_comments,
+                            external_id=source.external_id,
+                            domain_names=source.domain_names,
+                            details=source.details,
+                            notes=source.notes,
+                            group_id=source.group_id,
+                            tags=source.tags,
+                            organization_fields={'migrated': True})
+
+    # Returns the update for an existing org with the source org merged into it
+    def merge_org(self, existing, source):
+        domain_names = list(existing.domain_names)
+        for domain_name in source.domain_names:
+            if domain_name not in domain_names:
+                domain_names.append(domain_name)
+
+        tags = list(existing.tags)
+        for tag in source.tags:
+            if tag not in tags:
+                tags.append(tag)
+
+        details = existing.details
+        if existing.details and source.details:
+            details = existing.details + '\n' + source.details
+        elif not existing.details:
+            details = source.details
+
+        notes = existing.notes
+        if existing.notes and source.notes:
+            notes = existing.notes + '\n' + source.notes
+        elif not existing.notes:
+            notes = source.notes
+
+        organization_fields = dict(existing.organization_fields)
+        organization_fields['migrated'] = True
+
+        return Organization(id=existing.id,
+                            domain_names=domain_names,
+                            tags=tags,
+                            details=details,
+                            notes=notes,
+                            organization_fields=organization_fields)
+
     def find_for_name(self, name):
         result = None
 
@@ -89,7 +174,11 @@ class OrganizationMigration(BaseMigration):
 
 if __name__ == '__main__':
 
+    update_org = sys.argv[1] if len(sys.argv) > 1 else 'true'
     item_id = sys.argv[2] if len(sys.argv) > 2 else None
 
     migration = OrganizationMigration()
-    sys.exit(migration.main(item_id, update_org == 'true'))
+    if item_id == 'bulk':
+        sys.exit(migration.main(update=update_org == 'true', bulk=True))
+    else:
+        sys.exit(migration.main(item_id, update_org == 'true'))
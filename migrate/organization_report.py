@@ -3,41 +3,100 @@
 """
 Produces a CSV with a list of all Organizations in ZenDesk
 
+The organizations are pulled with the incremental export. The organizations and the export cursor are kept
+between runs, so repeat runs only fetch the organizations that changed since the last one.
+
 """
 import csv
+import json
+import os
 import sys
 
 from base_zendesk import BaseZendesk
-from json_to_csv import create_csv
 
 
 class OrganizationReport(BaseZendesk):
 
+    REPORT_FILE = 'organizations.csv'
+    SNAPSHOT_FILE = 'organizations-report.jsonl'
+    STATE_FILE = 'organizations-report.state'
+
+    WRITE_BUFFER_SIZE = 1024 * 1024
+
     def create_report(self):
 
-        with open('organizations.csv', 'w') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=',',
-                                   quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        start_time = 0
+        if os.path.exists(self.STATE_FILE) and os.path.exists(self.SNAPSHOT_FILE):
+            with open(self.STATE_FILE, 'r') as file:
+                start_time = json.load(file).get('start_time', 0)
+
+        print('Fetching organizations changed since %s' % start_time)
+        changed_ids = set()
+        end_time = start_time
+        tmp_snapshot = self.SNAPSHOT_FILE + '.tmp'
+        with open(tmp_snapshot, 'w', buffering=self.WRITE_BUFFER_SIZE) as snapshot:
+            path = '/api/v2/incremental/organizations.json?start_time=%s' % start_time
+            for page in self.get_incremental_pages_from_api(self.TARGET_INSTANCE, path, self.target_auth):
+                for org in page.get('organizations', []):
+                    # Orgs sharing a timestamp are repeated across page boundaries
+                    if org.get('id') in changed_ids:
+                        continue
+                    changed_ids.add(org.get('id'))
+                    if not org.get('deleted_at'):
+                        snapshot.write(json.dumps({'id': org.get('id'),
+                                                   'name': org.get('name'),
+                                                   'organization_fields': org.get('organization_fields')}) + '\n')
+
+                end_time = page.get('end_time') or end_time
+                print('- Fetched %s changed organizations' % len(changed_ids))
 
-            first = True
-            for org in self.target_client.organizations():
+            # Carry over the unchanged organizations from the last run
+            if start_time and os.path.exists(self.SNAPSHOT_FILE):
+                with open(self.SNAPSHOT_FILE, 'r') as old_snapshot:
+                    for line in old_snapshot:
+                        if json.loads(line).get('id') not in changed_ids:
+                            snapshot.write(line)
 
-                fields = org.organization_fields
+        os.replace(tmp_snapshot, self.SNAPSHOT_FILE)
+        with open(self.STATE_FILE, 'w') as file:
+            json.dump({'start_time': end_time}, file)
 
-                if first:
-                    print('Writing header')
-                    header = ['name']
-                    for key in fields:
-                        header.append(key)
-                    csvwriter.writerow(header)
-                    first = False
+        self.write_report()
 
-                print(org.name)
-                row = [org.name]
-                for key in fields:
+    def write_report(self):
+
+        # The header is the union of the field keys of all organizations
+        field_keys = []
+        seen_keys = set()
+        with open(self.SNAPSHOT_FILE, 'r') as snapshot:
+            for line in snapshot:
+                for key in json.loads(line).get('organization_fields') or {}:
+                    if key not in seen_keys:
+                        seen_keys.add(key)
+                        field_keys.append(key)
+
+        print('Writing report with %s organization fields' % len(field_keys))
+        counter = 0
+        with open(self.SNAPSHOT_FILE, 'r') as snapshot, \
+                open(self.REPORT_FILE, 'w', buffering=self.WRITE_BUFFER_SIZE) as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=',',
+                                   quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+            csvwriter.writerow(['name'] + field_keys)
+
+            for line in snapshot:
+                org = json.loads(line)
+                fields = org.get('organization_fields') or {}
+                row = [org.get('name')]
+                for key in field_keys:
                     row.append(fields.get(key))
                 csvwriter.writerow(row)
 
+                counter += 1
+                if counter % 10000 == 0:
+                    print('- Wrote %s organizations' % counter)
+
+        print('Wrote %s organizations to %s' % (counter, self.REPORT_FILE))
+
 
 if __name__ == '__main__':
     report = OrganizationReport()
@@ -1,24 +1,46 @@
 
 """
 Migrates tickets from one help center instance to another. The default settings will use the incremental
-export API to pull tickets. If the status_to_migrate is set to 'not_closed' the regular ticket API
-will be used since most incremental tickets are closed or deleted.
+export API to pull tickets. If the status_to_migrate is set to 'not_closed' or a status other than 'closed', the
+Search API is used with a status filter so only the matching tickets are pulled from the source, since most
+incremental tickets are closed or deleted.
 
 Can be run as a script that takes several command line arguments.
-The first argument is the action, which can be 'migrate' or 'update'
+The first argument is the action, which can be 'migrate', 'import', 'follow' or 'update'
 
 Migrate
 - ticket_id - Single ticket to migrate
     or
 - status_to_migrate - a valid status, 'all', or 'not closed'
-- filename (optional) - file that contains a list of ticket ids to migrate. Useful for error retries
+- filename (optional) - file that contains a list of ticket ids to migrate, one per line. The tickets are
+  fetched from the source in batches of 100. Useful for error retries
+Tickets go through fetch, resolve, attachments and import stages connected by bounded queues, each stage with its
+own workers. The queue depths are printed periodically, the fullest queue is in front of the slowest stage.
+
+Import
+- status_to_migrate (optional) - a valid status, 'all' (default) or 'not_closed'
+- filename (optional) - file that contains a list of ticket ids to import, one per line. The tickets are looked
+  up in the snapshot index
+Migrates the tickets of the local snapshot written by ticket_snapshot.py instead of reading the source. Users,
+organizations, groups, brands, ticket forms, ticket fields and problem tickets also come from the snapshot,
+attachment content is still downloaded from the source. The target is still read to resolve them.
+
+Follow
+Tails the source incremental ticket export from the last checkpoint (ticket_follow.state, or
+ZENDESK_TICKET_START_TIME on the first run) until interrupted. New tickets are migrated, tickets already in the
+target get their new comments and status changes. The state file also keeps the last comment applied to each
+followed ticket. The lag behind the source is printed after every poll.
 
 Update
 - field - What field to update. 'cc' or 'comment_attach'
 - ticket_id - Single ticket to migrate
+Without a ticket_id the target tickets are indexed by original id once and collaborator changes are sent
+as update_many jobs.
 """
 
+import datetime
 import fileinput
+import json
 import os
 import re
 import sys
@@ -30,6 +52,7 @@ from zenpy.lib.api_objects import Ticket, Comment
 from zenpy.lib.exception import APIException, ZenpyException
 
 from base_migration import BaseMigration
+from ticket_snapshot import TicketSnapshot
 
 
 class TicketMigration(BaseMigration):
@@ -37,6 +60,36 @@ class TicketMigration(BaseMigration):
     TICKET_ERRORS_LOG = 'ticket_errors.log'
     TICKET_START_TIME = os.getenv('ZENDESK_TICKET_START_TIME', 1262304000)
 
+    # Statuses pulled with a filtered search instead of the incremental export
+    SEARCH_STATUSES = ['not_closed', 'new', 'open', 'pending', 'hold', 'solved']
+    # The Search API returns at most this many results per query
+    SEARCH_RESULT_LIMIT = 1000
+    # Added to target tickets once the inline attachments comment has been created
+    ATTACHMENTS_UPDATED_TAG = 'migration_attachments_updated'
+
+    # Workers of the import stage of the migrate pipeline
+    IMPORT_WORKERS = int(os.getenv('ZENDESK_IMPORT_WORKERS', 2))
+    # Most tickets the resolve stage looks users up for at once
+    RESOLVE_BATCH_SIZE = 50
+
+    # Follow action: the incremental export position is kept in FOLLOW_STATE_FILE. Polling backs off from the min
+    # to the max interval while there are no changes
+    FOLLOW_STATE_FILE = 'ticket_follow.state'
+    FOLLOW_MIN_INTERVAL = 10
+    FOLLOW_MAX_INTERVAL = 300
+
+    # Set by the import action, see ticket_snapshot.py
+    snapshot = None
+    snapshot_users = None
+    snapshot_org_names = None
+    snapshot_references = None
+
+    # Entity names of get_target_entity_id -> record type in the snapshot references
+    SNAPSHOT_REFERENCE_TYPES = {'Group': 'group',
+                                'Brand': 'brand',
+                                'Ticket Form': 'ticket_form',
+                                'Ticket Field': 'ticket_field'}
+
     def main(self, action='migrate', **kwargs):
         start = time.time()
 
@@ -56,28 +109,34 @@ class TicketMigration(BaseMigration):
                 self.migrate(source_ticket, 'all')
                 counter += 1
             elif filename:
-                for line in fileinput.input(files=filename):
-                    source_ticket = self.source_client.tickets(id=line)
-                    self.migrate(source_ticket, status, 'all')
-                    counter += 1
+                source_tickets = self.get_source_tickets(self.read_ticket_ids(filename))
+                counter = self.migrate_pipeline(((source_ticket, None) for source_ticket in source_tickets),
+                                                status, start)
             else:
-                if status == 'not_closed':
-                    ticket_generator = self.source_client.tickets()
+                if status in self.SEARCH_STATUSES:
+                    ticket_generator = self.search_source_tickets(status)
                 else:
                     ticket_generator = self.source_client.tickets.incremental(start_time=self.TICKET_START_TIME)
 
-                for source_ticket in ticket_generator:
-                    generated_timestamp = 'N/A'
-                    try:
-                        generated_timestamp = source_ticket.generated_timestamp
-                    except AttributeError:
-                        pass
+                counter = self.migrate_pipeline(((source_ticket, None) for source_ticket in ticket_generator),
+                                                status, start)
 
-                    self.migrate(source_ticket, status, generated_timestamp)
-                    counter += 1
+        elif action == 'import':
+            # Same as migrate, but the tickets, comments, users and organizations come from the local snapshot
+            self.open_snapshot()
+            if filename:
+                records = self.find_snapshot_records(self.read_ticket_ids(filename))
+            elif self.snapshot.index_size:
+                records = self.snapshot.iter_ticket_records()
+            else:
+                print('WARN - No ticket index, tickets updated during the export are imported more than once. '
+                      'Run ticket_snapshot.py index first')
+                records = self.snapshot.iter_records(self.snapshot.TICKETS_FILE)
 
-                    if counter % 100 == 0:
-                        print('*** Processed %s tickets in % sec' % (counter, (time.time() - start)))
+            counter = self.migrate_pipeline((self.snapshot_ticket(record) for record in records), status, start)
+
+        elif action == 'follow':
+            counter = self.follow()
 
         elif action == 'update':
             update_field = kwargs.get('update_field')
@@ -86,25 +145,102 @@ class TicketMigration(BaseMigration):
                 self.update_ticket(source_ticket, update_field)
                 counter += 1
             else:
+                # Join source and target by original id instead of searching the target for every ticket
+                target_index = self.build_target_ticket_index()
+
+                # Collaborator changes are sent as update_many jobs
+                batch = []
+                jobs = []
+
                 ticket_generator = self.source_client.tickets()
                 for source_ticket in ticket_generator:
                     try:
-                        self.update_ticket(source_ticket, update_field)
+                        self.update_ticket(source_ticket, update_field,
+                                           target_index.get(str(source_ticket.id)), batch)
                     except ZenpyException as z:
                         self.handle_error(z, source_ticket)
 
+                    if len(batch) >= self.SHOW_MANY_LIMIT:
+                        self.submit_ticket_updates(batch, jobs)
+
+                    counter += 1
+                    if counter % 100 == 0:
+                        print('*** Processed %s tickets in % sec' % (counter, (time.time() - start)))
+
+                self.submit_ticket_updates(batch, jobs, wait=True)
+
+        self.print_unresolved_references()
+
         end = time.time()
         print('Complete: processed %s tickets in %s sec' % (counter, (end - start)))
 
-    def migrate(self, source, status_to_migrate, generated_timestamp='N/A'):
+    def read_ticket_ids(self, filename):
+        # One ticket id per line, blank lines are ignored
+        for line in fileinput.input(files=filename):
+            line = line.strip()
+            if line:
+                yield line
+
+    def get_source_tickets(self, ticket_ids):
+        # Fetch the tickets in batches with the show_many endpoint instead of one request per id
+        for chunk in self.chunks(ticket_ids, self.SHOW_MANY_LIMIT):
+            found = set()
+            for source_ticket in self.source_client.tickets(ids=chunk):
+                found.add(str(source_ticket.id))
+                yield source_ticket
+
+            for missing_id in chunk:
+                if missing_id not in found:
+                    print('ERROR - Source ticket not found for %s' % missing_id)
+                    with open(self.TICKET_ERRORS_LOG, 'a') as file:
+                        file.write('ERROR processing ticket %s: Source ticket not found\n' % missing_id)
+
+    def search_source_tickets(self, status):
+        query = {'type': 'ticket', 'sort_by': 'created_at', 'sort_order': 'asc'}
+        if status == 'not_closed':
+            query['status_less_than'] = 'closed'
+        else:
+            query['status'] = status
+
+        # Search results are capped, so page forward through created_at windows. Each window starts
+        # a second before the last ticket seen so tickets created in the same second are not lost.
+        seen = set()
+        created_after = None
+        while True:
+            if created_after:
+                query['created_after'] = created_after
+
+            results = 0
+            new_results = 0
+            last_created = None
+            for source_ticket in self.source_client.search(**query):
+                results += 1
+                last_created = source_ticket.created_at
+                if source_ticket.id not in seen:
+                    seen.add(source_ticket.id)
+                    new_results += 1
+                    yield source_ticket
+
+                # Asking for the page past the limit fails with a 422
+                if results >= self.SEARCH_RESULT_LIMIT:
+                    break
+
+            if results < self.SEARCH_RESULT_LIMIT or new_results == 0:
+                break
+
+            last_created = datetime.datetime.strptime(last_created, '%Y-%m-%dT%H:%M:%SZ')
+            created_after = (last_created - datetime.timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            print('*** Search limit reached, continuing with tickets created after %s' % created_after)
+
+    def migrate(self, source, status_to_migrate, generated_timestamp='N/A', comments=None):
         try:
-            self.migrate_ticket(source, status_to_migrate)
+            self.migrate_ticket(source, status_to_migrate, comments)
         except APIException as e:
             if e.response.status_code == 500:
                 print('- Internal Server Error creating ticket, retrying')
                 time.sleep(60)
                 try:
-                    self.migrate_ticket(source, status_to_migrate)
+                    self.migrate_ticket(source, status_to_migrate, comments)
                 except APIException as e2:
                     self.handle_error(e2, source, generated_timestamp)
             else:
@@ -112,18 +248,119 @@ class TicketMigration(BaseMigration):
         except ZenpyException as z:
             self.handle_error(z, source, generated_timestamp)
 
+    # Migrate (source ticket, comments) pairs through the fetch, resolve, attachments and import stages, each with
+    # its own workers, see run_pipeline. Users are resolved by a single worker so a user referenced by several
+    # tickets is created once, for all the tickets waiting in the queue at a time. Returns the number of tickets
+    # processed
+    def migrate_pipeline(self, source_tickets, status_to_migrate, start):
+        jobs = ({'source': source, 'comments': comments, 'status': status_to_migrate}
+                for source, comments in source_tickets)
+        stages = [('fetch', self.ticket_stage(self.fetch_stage), self.MAX_WORKERS),
+                  ('resolve', self.resolve_stage, 1, self.RESOLVE_BATCH_SIZE),
+                  ('attachments', self.ticket_stage(self.attachments_stage), self.MAX_WORKERS),
+                  ('import', self.ticket_stage(self.import_stage), self.IMPORT_WORKERS)]
+
+        counter = 0
+        for job in self.run_pipeline(jobs, stages):
+            counter += 1
+            if counter % 100 == 0:
+                print('*** Processed %s tickets in % sec' % (counter, (time.time() - start)))
+
+        return counter
+
+    # Jobs that were skipped or failed pass through the remaining stages untouched. Failures are logged to the
+    # errors log so the ticket can be retried
+    def ticket_stage(self, func):
+        def run(job):
+            if not job.get('done'):
+                try:
+                    func(job)
+                except Exception as e:
+                    self.handle_error(e, job.get('source'), self.ticket_timestamp(job.get('source')))
+                    job['done'] = True
+            return job
+
+        return run
+
+    def fetch_stage(self, job):
+        source = job.get('source')
+        if self.check_source_ticket(source, job.get('status')) is not None:
+            job['done'] = True
+            return
+
+        print('Migrating ticket %s - %s' % (source.id, source.subject))
+        if job.get('comments') is None:
+            job['comments'] = list(self.source_client.tickets.comments(source))
+
+    # Resolve the users of a batch of jobs together, then map the fields of each ticket
+    def resolve_stage(self, jobs):
+        user_ids = []
+        for job in jobs:
+            if not job.get('done'):
+                source = job.get('source')
+                user_ids.extend([source.submitter_id, source.requester_id, source.assignee_id])
+                user_ids.extend(source.collaborator_ids)
+                user_ids.extend([comment.author_id for comment in job.get('comments')])
+
+        try:
+            self.resolve_target_users(user_ids)
+        except Exception as e:
+            # Each ticket resolves its own users again in prepare_ticket
+            print('WARN - Unable to resolve users for %s tickets: %s' % (len(jobs), e))
+
+        prepare = self.ticket_stage(self.prepare_stage)
+        return [prepare(job) for job in jobs]
+
+    def prepare_stage(self, job):
+        job['ticket'] = self.prepare_ticket(job.get('source'), job.get('comments'))
+
+    def attachments_stage(self, job):
+        job['new_comments'] = [self.build_comment(comment) for comment in job.get('comments')]
+
+    def import_stage(self, job):
+        source = job.get('source')
+        ticket = job.get('ticket')
+        ticket.comments = list(job.get('new_comments'))
+        try:
+            self.import_ticket(source, ticket)
+        except APIException as e:
+            if not e.response.status_code == 500:
+                raise
+
+            print('- Internal Server Error creating ticket, retrying')
+            time.sleep(60)
+            ticket = self.prepare_ticket(source, job.get('comments'))
+            ticket.comments = list(job.get('new_comments'))
+            self.import_ticket(source, ticket)
+
     def handle_error(self, e, source, generated_timestamp='N/A'):
         print('ERROR processing ticket %s: %s (timestamp: %s)' % (source.id, e, generated_timestamp))
         with open(self.TICKET_ERRORS_LOG, 'a') as file:
             file.write('ERROR processing ticket %s: %s\n' % (source.id, e))
 
-    def migrate_ticket(self, source, status_to_migrate='all'):
+    def migrate_ticket(self, source, status_to_migrate='all', comments=None):
+        existing_id = self.check_source_ticket(source, status_to_migrate)
+        if existing_id is not None:
+            return existing_id
+
+        print('Migrating ticket %s - %s' % (source.id, source.subject))
 
-        end_time = 'N/A'
+        if comments is None:
+            comments = list(self.source_client.tickets.comments(source))
+
+        ticket = self.prepare_ticket(source, comments)
+        ticket.comments = [self.build_comment(comment) for comment in comments]
+        return self.import_ticket(source, ticket)
+
+    def ticket_timestamp(self, source):
         try:
-            end_time = source.generated_timestamp
+            return source.generated_timestamp
         except AttributeError:
-            pass
+            return 'N/A'
+
+    # Returns 0 when the ticket is skipped, the target id when it was migrated already, otherwise None
+    def check_source_ticket(self, source, status_to_migrate='all'):
+        end_time = self.ticket_timestamp(source)
 
         if source.status == 'deleted':
             print('Skipping deleted ticket: %s (timestamp: %s)' % (source.id, end_time))
@@ -143,7 +380,15 @@ class TicketMigration(BaseMigration):
             print('Existing ticket found for %s (timestamp: %s)' % (source.id, end_time))
             return existing.id
 
-        print('Migrating ticket %s - %s' % (source.id, source.subject))
+        return None
+
+    # Target ticket with the references of the source ticket resolved, without the comments
+    def prepare_ticket(self, source, comments):
+        # Resolve every user referenced by the ticket up front
+        user_ids = [source.submitter_id, source.requester_id, source.assignee_id]
+        user_ids.extend(source.collaborator_ids)
+        user_ids.extend([comment.author_id for comment in comments])
+        self.resolve_target_users(user_ids)
 
         ticket = Ticket(created_at=source.created_at,
                         updated_at=source.updated_at,
@@ -181,110 +426,11 @@ class TicketMigration(BaseMigration):
         custom_fields[self.original_id_field] = source.id
         ticket.custom_fields = custom_fields
 
-        # Comments
-        comments = self.source_client.tickets.comments(source)
-        new_comments = []
+        return ticket
 
-        for comment in comments:
-            new_comment = Comment(created_at=comment.created_at,
-                                  html_body=comment.html_body,
-                                  public=comment.public,
-                                  metadata=comment.metadata)
-
-            # Author
-            author_id = comment.author_id
-            new_comment.author_id = self.get_target_user_id(author_id)
-
-            # Inline Attachments
-            comment_body = comment.html_body
-            uploads = []
-            matches = re.findall(self.HTML_IMG_TAG_PATTERN, comment_body)
-            if len(matches) > 0:
-
-                for match in matches:
-                    img_tag = match[0]
-                    url = match[1]
-
-                    print('- Found src url in comment: %s' % url)
-
-                    do_upload = False
-                    source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
-                    source_alt_domain = '%s.zendesk.com' % self.SOURCE_ALT_INSTANCE
-                    if source_domain in url or source_alt_domain in url:
-                        do_upload = True
-                        url = url.replace(source_alt_domain, source_domain)
-                    elif self.SOURCE_HELPCENTER_DOMAIN in url:
-                        do_upload = True
-
-                    if do_upload:
-                        response = requests.get(url, auth=self.source_auth)
-
-                        if not response.status_code == 200:
-                            print('- ERROR getting attachment %s: %s' % (url, response.status_code))
-                            continue
-
-                        file_name = 'attachment'
-                        content_disp = response.headers.get('content-disposition')
-                        if content_disp:
-                            file_name_match = re.search('inline; filename=\"(.*)\"', content_disp)
-                            if file_name_match:
-                                file_name = file_name_match.group(1)
-                            else:
-                                continue
-                        content_type = response.headers.get('content-type')
-
-                        if self.DEBUG:
-                            print('- DEBUG Attachment created - %s' % file_name)
-                            comment_body = comment_body.replace(img_tag, '<See Attachment>')
-                        else:
-                            with tempfile.TemporaryFile() as tmp_file:
-                                tmp_file.write(response.content)
-                                tmp_file.seek(0)
-                                try:
-                                    upload = self.target_client.attachments.upload(fp=tmp_file,
-                                                                                   target_name=file_name,
-                                                                                   content_type=content_type)
-
-                                    print('- Attachment created - %s' % file_name)
-                                    comment_body = comment_body.replace(img_tag, '[See Attachment]')
-                                    uploads.append(upload.token)
-
-                                except Exception as e:
-                                    print('WARN Exception creating attachment %s - %s' % (file_name, e))
-
-                new_comment.html_body = comment_body
-
-            # Non-inline Attachments
-            attachments = comment.attachments
-            if attachments and len(attachments) > 0:
-                for attachment in attachments:
-                    url = attachment.content_url
-                    file_name = attachment.file_name
-                    content_type = attachment.content_type
-                    response = requests.get(url)
-
-                    if self.DEBUG:
-                        print('- DEBUG Attachment created - %s' % file_name)
-                    else:
-                        with tempfile.TemporaryFile() as tmp_file:
-                            tmp_file.write(response.content)
-                            tmp_file.seek(0)
-                            try:
-                                upload = self.target_client.attachments.upload(fp=tmp_file,
-                                                                               target_name=file_name,
-                                                                               content_type=content_type)
-
-                                print('- Attachment created - %s' % file_name)
-                                uploads.append(upload.token)
-
-                            except Exception as e:
-                                print('WARN Exception creating attachment %s - %s' % (file_name, e))
-
-            new_comment.uploads = uploads
-
-            new_comments.append(new_comment)
-
-        ticket.comments = new_comments
+    # Add the requester, assignee and problem ticket and import the ticket with its comments
+    def import_ticket(self, source, ticket):
+        end_time = self.ticket_timestamp(source)
 
         # Submitter
         ticket.submitter_id = self.get_target_user_id(source.submitter_id)
@@ -337,8 +483,8 @@ class TicketMigration(BaseMigration):
                     print('- DEBUG Problem ticket not found, creating for %s' % source_problem_id)
                 else:
                     print('- Problem ticket not found, creating for %s' % source_problem_id)
-                    source_problem = self.source_client.tickets(id=source_problem_id)
-                    ticket.problem_id = self.migrate_ticket(source_problem)
+                    source_problem, problem_comments = self.get_source_ticket(source_problem_id)
+                    ticket.problem_id = self.migrate_ticket(source_problem, comments=problem_comments)
                     # Wait 60 sec for this to show up
                     time.sleep(60)
 
@@ -352,40 +498,379 @@ class TicketMigration(BaseMigration):
 
         return new_ticket_id
 
-    def update_ticket(self, source, update_field):
+    def open_snapshot(self):
+        self.snapshot = TicketSnapshot()
+        manifest = self.snapshot.load_manifest()
+        print('Reading snapshot of %s taken at %s' % (manifest.get('source_instance'), manifest.get('started_at')))
+        for file_name, entry in manifest.get('files').items():
+            print('- %s: %s records' % (file_name, entry.get('records')))
+
+        self.snapshot_users = self.snapshot.load_users()
+        self.snapshot_org_names = self.snapshot.load_organization_names()
+        self.snapshot_references = self.snapshot.load_references()
+        if os.path.exists(self.snapshot.path(self.snapshot.INDEX_FILE)):
+            self.snapshot.open_index()
+
+    # Snapshot records for the ticket ids, looked up in the snapshot index
+    def find_snapshot_records(self, ticket_ids):
+        for ticket_id in ticket_ids:
+            record = self.snapshot.find_ticket_record(ticket_id) if self.snapshot.index_size else None
+            if record:
+                yield record
+            else:
+                print('ERROR - Snapshot ticket not found for %s' % ticket_id)
+                with open(self.TICKET_ERRORS_LOG, 'a') as file:
+                    file.write('ERROR processing ticket %s: Snapshot ticket not found\n' % ticket_id)
+
+    # Source ticket and its comments, from the snapshot index when importing. The comments are None when they
+    # have to be read from the source
+    def get_source_ticket(self, ticket_id):
+        if self.snapshot is not None and self.snapshot.index_size:
+            record = self.snapshot.find_ticket_record(ticket_id)
+            if record:
+                return self.snapshot_ticket(record)
+
+        return self.source_client.tickets(id=ticket_id), None
+
+    # Source ticket and comment objects for a snapshot record. The comments are None when they could not be
+    # exported, they are then read from the source
+    def snapshot_ticket(self, record):
+        object_mapping = self.source_client.tickets._object_mapping
+        source_ticket = object_mapping.object_from_json('ticket', record.get('ticket'))
+        comments = record.get('comments')
+        if comments is not None:
+            comments = [object_mapping.object_from_json('comment', comment) for comment in comments]
+
+        return source_ticket, comments
+
+    def get_source_users_json(self, source_user_ids):
+        if self.snapshot is None:
+            return super().get_source_users_json(source_user_ids)
+
+        users = []
+        identities = {}
+        for source_user_id in source_user_ids:
+            record = self.snapshot_users.get(int(source_user_id))
+            if record:
+                users.append(record.get('user'))
+                identities[record.get('user').get('id')] = record.get('identities')
+
+        return users, identities
+
+    def get_source_org_name(self, source_org_id):
+        if self.snapshot is None:
+            return super().get_source_org_name(source_org_id)
+
+        return self.snapshot_org_names.get(int(source_org_id))
+
+    # Snapshots taken before the references were exported fall back to the source
+    def get_source_entity(self, entity_name, source_id, source_func):
+        if self.snapshot is None or not self.snapshot_references:
+            return super().get_source_entity(entity_name, source_id, source_func)
+
+        record_type = self.SNAPSHOT_REFERENCE_TYPES.get(entity_name)
+        entity = self.snapshot_references.get((record_type, int(source_id)))
+        if entity is None:
+            return None
+
+        return self.source_client.tickets._object_mapping.object_from_json(record_type, entity)
+
+    # Target comment for a source comment. Inline images and attachments are copied to the target as uploads
+    def build_comment(self, comment):
+        new_comment = Comment(created_at=comment.created_at,
+                              html_body=comment.html_body,
+                              public=comment.public,
+                              metadata=comment.metadata)
+
+        # Author
+        author_id = comment.author_id
+        new_comment.author_id = self.get_target_user_id(author_id)
+
+        # Inline Attachments
+        comment_body = comment.html_body
+        uploads = []
+        matches = re.findall(self.HTML_IMG_TAG_PATTERN, comment_body)
+        if len(matches) > 0:
+
+            for match in matches:
+                img_tag = match[0]
+                url = match[1]
+
+                print('- Found src url in comment: %s' % url)
+
+                do_upload = False
+                source_domain = '%s.zendesk.com' % self.SOURCE_INSTANCE
+                source_alt_domain = '%s.zendesk.com' % self.SOURCE_ALT_INSTANCE
+                if source_domain in url or source_alt_domain in url:
+                    do_upload = True
+                    url = url.replace(source_alt_domain, source_domain)
+                elif self.SOURCE_HELPCENTER_DOMAIN in url:
+                    do_upload = True
+
+                if do_upload:
+                    response = requests.get(url, auth=self.source_auth)
+
+                    if not response.status_code == 200:
+                        print('- ERROR getting attachment %s: %s' % (url, response.status_code))
+                        continue
+
+                    file_name = 'attachment'
+                    content_disp = response.headers.get('content-disposition')
+                    if content_disp:
+                        file_name_match = re.search('inline; filename=\"(.*)\"', content_disp)
+                        if file_name_match:
+                            file_name = file_name_match.group(1)
+                        else:
+                            continue
+                    content_type = response.headers.get('content-type')
 
-        ticket = self.find_target_ticket_for_original_id(source.id)
+                    if self.DEBUG:
+                        print('- DEBUG Attachment created - %s' % file_name)
+                        comment_body = comment_body.replace(img_tag, '<See Attachment>')
+                    else:
+                        with tempfile.TemporaryFile() as tmp_file:
+                            tmp_file.write(response.content)
+                            tmp_file.seek(0)
+                            try:
+                                upload = self.target_client.attachments.upload(fp=tmp_file,
+                                                                               target_name=file_name,
+                                                                               content_type=content_type)
+
+                                print('- Attachment created - %s' % file_name)
+                                comment_body = comment_body.replace(img_tag, '[See Attachment]')
+                                uploads.append(upload.token)
 
-        if not ticket:
+                            except Exception as e:
+                                print('WARN Exception creating attachment %s - %s' % (file_name, e))
+
+            new_comment.html_body = comment_body
+
+        # Non-inline Attachments
+        attachments = comment.attachments
+        if attachments and len(attachments) > 0:
+            for attachment in attachments:
+                url = attachment.content_url
+                file_name = attachment.file_name
+                content_type = attachment.content_type
+                response = requests.get(url)
+
+                if self.DEBUG:
+                    print('- DEBUG Attachment created - %s' % file_name)
+                else:
+                    with tempfile.TemporaryFile() as tmp_file:
+                        tmp_file.write(response.content)
+                        tmp_file.seek(0)
+                        try:
+                            upload = self.target_client.attachments.upload(fp=tmp_file,
+                                                                           target_name=file_name,
+                                                                           content_type=content_type)
+
+                            print('- Attachment created - %s' % file_name)
+                            uploads.append(upload.token)
+
+                        except Exception as e:
+                            print('WARN Exception creating attachment %s - %s' % (file_name, e))
+
+        new_comment.uploads = uploads
+
+        return new_comment
+
+    # Tail the source incremental ticket export until interrupted. New tickets are migrated, tickets already in the
+    # target index get their new comments and status applied. Returns the number of tickets processed
+    def follow(self):
+        start_time = int(self.TICKET_START_TIME)
+        comment_marks = {}
+        if os.path.exists(self.FOLLOW_STATE_FILE):
+            with open(self.FOLLOW_STATE_FILE, 'r') as file:
+                state = json.load(file)
+            start_time = state.get('start_time', start_time)
+            comment_marks = state.get('comment_marks', comment_marks)
+
+        target_index = self.build_target_ticket_index()
+        interval = self.FOLLOW_MIN_INTERVAL
+        counter = 0
+        try:
+            while True:
+                poll_started = time.time()
+                changes = 0
+                path = '/api/v2/incremental/tickets.json?start_time=%s' % start_time
+                try:
+                    for page in self.get_incremental_pages_from_api(self.SOURCE_INSTANCE, path, self.source_auth):
+                        object_mapping = self.source_client.tickets._object_mapping
+                        for ticket_json in page.get('tickets', []):
+                            source_ticket = object_mapping.object_from_json('ticket', ticket_json)
+                            # A failing ticket is logged for a retry, it must not stop the tail
+                            try:
+                                if self.follow_ticket(source_ticket, target_index, comment_marks):
+                                    self.save_follow_state(start_time, comment_marks)
+                            except Exception as e:
+                                self.handle_error(e, source_ticket)
+                            changes += 1
+
+                        start_time = page.get('end_time') or start_time
+                        self.save_follow_state(start_time, comment_marks)
+                        print('*** Processed %s changed tickets, lag %s sec behind source' %
+                              (changes, int(time.time() - start_time)))
+                except requests.RequestException as e:
+                    # The next poll starts again from the last saved page
+                    print('WARN - Polling the incremental export failed, retrying: %s' % e)
+
+                counter += changes
+                interval = self.FOLLOW_MIN_INTERVAL if changes else min(interval * 2, self.FOLLOW_MAX_INTERVAL)
+                print('*** Caught up with source as of %s sec ago, %s tickets changed, next poll in %s sec' %
+                      (int(time.time() - poll_started), changes, interval))
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopped following at %s' % start_time)
+
+        return counter
+
+    # The comment marks are kept with the checkpoint, the comments applied by follow_ticket get the time of the
+    # update as their created_at in the target
+    def save_follow_state(self, start_time, comment_marks):
+        tmp_file = self.FOLLOW_STATE_FILE + '.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump({'start_time': start_time, 'comment_marks': comment_marks}, file)
+        os.replace(tmp_file, self.FOLLOW_STATE_FILE)
+
+    # Returns True when comments were applied to the target ticket
+    def follow_ticket(self, source, target_index, comment_marks):
+        target = target_index.get(str(source.id))
+        if not target:
+            new_ticket = self.migrate_ticket(source)
+            new_ticket_id = getattr(new_ticket, 'id', new_ticket)
+            if new_ticket_id:
+                target_index[str(source.id)] = {'original_id': str(source.id),
+                                                'id': new_ticket_id,
+                                                'status': source.status,
+                                                'subject': source.subject,
+                                                'collaborator_ids': [],
+                                                'tags': list(source.tags)}
+            return
+
+        if source.status == 'deleted' or target.get('status') in ('deleted', 'closed'):
+            print('Skipping %s ticket: %s' % (target.get('status'), target.get('id')))
+            return
+
+        # Source created_at of the last comment applied by follow, kept in the follow state. Comments are imported
+        # with their source created_at, so for a ticket not followed yet the newest target comment marks what was
+        # applied
+        last_applied = comment_marks.get(str(target.get('id')))
+        if last_applied is None:
+            last_applied = max([comment.created_at for comment in
+                                self.target_client.tickets.comments(ticket=target.get('id'))] or [''])
+
+        comments = [comment for comment in self.source_client.tickets.comments(ticket=source.id)
+                    if comment.created_at > last_applied]
+        self.resolve_target_users([comment.author_id for comment in comments])
+
+        # Closed can't be set with an update, solved tickets are closed by the target
+        status = 'solved' if source.status == 'closed' else source.status
+        for comment in comments:
+            ticket = Ticket(id=target.get('id'), comment=self.build_comment(comment))
+            if not status == target.get('status'):
+                ticket.status = status
+                target['status'] = status
+            self.target_client.tickets.update(ticket)
+            last_applied = comment.created_at
+            print('- Applied comment %s to ticket %s' % (comment.id, target.get('id')))
+
+        if not status == target.get('status'):
+            self.target_client.tickets.update(Ticket(id=target.get('id'), status=status))
+            target['status'] = status
+            print('- Updated status of ticket %s to %s' % (target.get('id'), status))
+
+        comment_marks[str(target.get('id'))] = last_applied
+        return len(comments) > 0
+
+    def build_target_ticket_index(self):
+        # Map each original source id to the target ticket fields needed by the update action
+        print('Building target ticket index')
+        index = {}
+        for ticket in self.target_client.tickets.incremental(start_time=self.TICKET_START_TIME):
+            entry = self.ticket_index_entry(ticket)
+            if entry:
+                index[entry.get('original_id')] = entry
+
+        print('- Indexed %s target tickets' % len(index))
+        return index
+
+    def ticket_index_entry(self, ticket):
+        for field in ticket.custom_fields:
+            if field.get('id') == self.original_id_field and field.get('value'):
+                return {'original_id': str(field.get('value')),
+                        'id': ticket.id,
+                        'status': ticket.status,
+                        'subject': ticket.subject,
+                        'collaborator_ids': list(ticket.collaborator_ids),
+                        'tags': list(ticket.tags)}
+
+        return None
+
+    def submit_ticket_updates(self, batch, jobs, wait=False):
+        if len(batch) > 0:
+            print('- Submitting update job for %s tickets' % len(batch))
+            jobs.append(self.target_client.tickets.update(list(batch)))
+            del batch[:]
+
+        if len(jobs) > 0 and (wait or len(jobs) >= self.MAX_QUEUED_JOBS):
+            self.wait_for_jobs(self.target_client, jobs)
+            del jobs[:]
+
+    def update_ticket(self, source, update_field, target=None, batch=None):
+
+        if target is None and batch is None:
+            # Not running from the index, look the ticket up
+            ticket = self.find_target_ticket_for_original_id(source.id)
+            target = self.ticket_index_entry(ticket) if ticket else None
+
+        if not target:
             print('Target ticket not found for %s' % source.id)
             return 0
-        elif ticket.status == 'deleted' or ticket.status == 'closed':
-            print('Skipping %s ticket: %s' % (ticket.status, ticket.id))
+        elif target.get('status') == 'deleted' or target.get('status') == 'closed':
+            print('Skipping %s ticket: %s' % (target.get('status'), target.get('id')))
             return 0
 
-        print('Ticket %s - %s' % (ticket.id, ticket.subject))
+        print('Ticket %s - %s' % (target.get('id'), target.get('subject')))
 
         if update_field == 'cc':
 
             if len(source.collaborator_ids) > 0:
-                new_collab_ids = ticket.collaborator_ids
+                self.resolve_target_users(source.collaborator_ids)
+                new_collab_ids = list(target.get('collaborator_ids'))
                 for collab_id in source.collaborator_ids:
-                    new_collab_ids.append(self.get_target_user_id(collab_id))
-
-                ticket.collaborator_ids = new_collab_ids
-                self.target_client.tickets.update(ticket)
-                print('- Successfully updated collaborators for ticket %s' % ticket.id)
+                    new_collab_id = self.get_target_user_id(collab_id)
+                    if new_collab_id not in new_collab_ids:
+                        new_collab_ids.append(new_collab_id)
+
+                ticket = Ticket(id=target.get('id'), collaborator_ids=new_collab_ids)
+                if batch is not None:
+                    batch.append(ticket)
+                    print('- Queued collaborator update for ticket %s' % ticket.id)
+                else:
+                    self.target_client.tickets.update(ticket)
+                    print('- Successfully updated collaborators for ticket %s' % ticket.id)
             else:
-                print('- No collaborators to update for ticket %s' % ticket.id)
+                print('- No collaborators to update for ticket %s' % target.get('id'))
 
         elif update_field == 'comment_attach':
-            for comment in self.target_client.tickets.comments(ticket=ticket):
+            if self.ATTACHMENTS_UPDATED_TAG in target.get('tags'):
+                print('- Skipping, ticket already updated')
+                return
+
+            source_comments = list(self.source_client.tickets.comments(ticket=source))
+            if not any(re.search(self.HTML_IMG_TAG_PATTERN, c.html_body) for c in source_comments):
+                print('- No inline attachments for ticket %s' % target.get('id'))
+                return
+
+            # Tickets updated before the tag was added only have the comment marker
+            for comment in self.target_client.tickets.comments(ticket=target.get('id')):
                 if comment.body == 'Inline attachments':
                     print('- Skipping, ticket already updated')
                     return
 
             uploads = []
-            for source_comment in self.source_client.tickets.comments(ticket=source):
+            for source_comment in source_comments:
 
                 matches = re.findall(self.HTML_IMG_TAG_PATTERN, source_comment.html_body)
                 for match in matches:
@@ -437,6 +922,8 @@ class TicketMigration(BaseMigration):
                                     print('WARN Exception creating attachment %s - %s' % (file_name, e))
 
             if len(uploads) > 0:
+                ticket = Ticket(id=target.get('id'),
+                                tags=target.get('tags') + [self.ATTACHMENTS_UPDATED_TAG])
                 ticket.comment = Comment(html_body='Inline attachments',
                                          public=False,
                                          uploads=uploads)
@@ -462,6 +949,10 @@ if __name__ == '__main__':
                 migrate.main(action_arg, status=arg2, filename=arg3)
         else:
             migrate.main(action_arg, status='closed')
+    elif action_arg == 'follow':
+        migrate.main(action_arg)
+    elif action_arg == 'import':
+        migrate.main(action_arg, status=arg2 or 'all', filename=arg3)
     elif action_arg == 'update':
         migrate.main(action_arg, update_field=arg2, ticket_id=arg3)
 
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+Exports the source tickets, their comments, users and organizations to a local snapshot so ticket imports can be
+rehearsed without reading the source instance again. See the 'import' action of ticket_migration.py.
+
+The snapshot directory (ZENDESK_SNAPSHOT_DIR, default 'snapshot') holds gzipped NDJSON files and a manifest:
+- tickets.jsonl.gz - one {"ticket": ..., "comments": [...]} record per ticket. The comments keep the attachment
+  metadata, the attachment content is still downloaded from the source at import time
+- users.jsonl.gz - one {"user": ..., "identities": [...]} record per user
+- organizations.jsonl.gz - one organization per line
+- references.jsonl.gz - one {"type": ..., "entity": ...} record per group, brand, ticket form and ticket field
+- tickets.idx - sorted (ticket_id, offset, length) entries locating the latest record of each ticket in
+  tickets.jsonl.gz
+- manifest.json - source instance, export window and record counts
+
+Every record is written as its own gzip member, so a record can be decompressed on its own. The index is memory
+mapped by the readers, which look tickets up with a binary search and only decompress the matching record.
+A ticket updated during the export is written again by the incremental export, the index points to its last
+record and the earlier ones are ignored.
+
+The import still reads the target instance to find the users, organizations, groups, brands, forms and fields
+that the snapshot references point to.
+
+Can be run as a script without arguments to export, or with 'index' to rebuild the index of an existing snapshot.
+"""
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+from base_zendesk import BaseZendesk
+
+
+class TicketSnapshot(BaseZendesk):
+
+    SNAPSHOT_DIR = os.getenv('ZENDESK_SNAPSHOT_DIR', 'snapshot')
+    TICKET_START_TIME = os.getenv('ZENDESK_TICKET_START_TIME', 1262304000)
+
+    MANIFEST_FILE = 'manifest.json'
+    TICKETS_FILE = 'tickets.jsonl.gz'
+    USERS_FILE = 'users.jsonl.gz'
+    ORGS_FILE = 'organizations.jsonl.gz'
+    REFERENCES_FILE = 'references.jsonl.gz'
+    INDEX_FILE = 'tickets.idx'
+
+    # Index entry: ticket id, offset and length of the gzip member in the tickets file
+    INDEX_ENTRY = struct.Struct('<QQI')
+    READ_CHUNK_SIZE = 64 * 1024
+    index_size = 0
+
+    WRITE_BUFFER_SIZE = 1024 * 1024
+
+    # Endpoint and record type of the entities referenced by the tickets
+    REFERENCE_TYPES = (('groups', 'group'),
+                       ('brands', 'brand'),
+                       ('ticket_forms', 'ticket_form'),
+                       ('ticket_fields', 'ticket_field'))
+
+    def export(self):
+        start = time.time()
+        os.makedirs(self.SNAPSHOT_DIR, exist_ok=True)
+
+        manifest = {'source_instance': self.SOURCE_INSTANCE,
+                    'ticket_start_time': int(self.TICKET_START_TIME),
+                    'started_at': int(start),
+                    'files': {}}
+
+        manifest['files'][self.ORGS_FILE] = self.export_organizations()
+        manifest['files'][self.USERS_FILE] = self.export_users()
+        manifest['files'][self.REFERENCES_FILE] = self.export_references()
+        ticket_file, end_time = self.export_tickets()
+        manifest['files'][self.TICKETS_FILE] = ticket_file
+        manifest['files'][self.INDEX_FILE] = self.file_entry(self.INDEX_FILE, ticket_file.get('records'))
+        manifest['ticket_end_time'] = end_time
+        manifest['finished_at'] = int(time.time())
+
+        with open(self.path(self.MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+        print('Snapshot written to %s in %s sec' % (self.SNAPSHOT_DIR, time.time() - start))
+
+    def export_organizations(self):
+        print('Exporting organizations')
+        path = '/api/v2/incremental/organizations.json?start_time=0'
+        seen = set()
+        with self.open_writer(self.ORGS_FILE) as file:
+            for page in self.get_incremental_pages_from_api(self.SOURCE_INSTANCE, path, self.source_auth):
+                for org in page.get('organizations', []):
+                    if org.get('id') not in seen:
+                        seen.add(org.get('id'))
+                        self.write_record(file, org)
+
+                print('- Exported %s organizations' % len(seen))
+
+        return self.file_entry(self.ORGS_FILE, len(seen))
+
+    def export_users(self):
+        print('Exporting users')
+        path = '/api/v2/incremental/users.json?start_time=0&include=identities'
+        seen = set()
+        with self.open_writer(self.USERS_FILE) as file:
+            for page in self.get_incremental_pages_from_api(self.SOURCE_INSTANCE, path, self.source_auth):
+                identities = {}
+                for identity in page.get('identities', []):
+                    identities.setdefault(identity.get('user_id'), []).append(identity)
+
+                for user in page.get('users', []):
+                    if user.get('id') not in seen:
+                        seen.add(user.get('id'))
+                        self.write_record(file, {'user': user, 'identities': identities.get(user.get('id'), [])})
+
+                print('- Exported %s users' % len(seen))
+
+        return self.file_entry(self.USERS_FILE, len(seen))
+
+    def export_references(self):
+        print('Exporting groups, brands, ticket forms and ticket fields')
+        count = 0
+        with self.open_writer(self.REFERENCES_FILE) as file:
+            for endpoint, record_type in self.REFERENCE_TYPES:
+                for entity in self.iter_list_from_api(instance=self.SOURCE_INSTANCE,
+                                                      path='/api/v2/%s.json' % endpoint,
+                                                      auth=self.source_auth,
+                                                      entity_name=endpoint):
+                    self.write_record(file, {'type': record_type, 'entity': entity})
+                    count += 1
+
+        print('- Exported %s references' % count)
+        return self.file_entry(self.REFERENCES_FILE, count)
+
+    # The comments of each page of tickets are fetched on the worker pool. A ticket updated while the export runs
+    # comes back in a later page and is written again, the index keeps its last record
+    def export_tickets(self):
+        print('Exporting tickets')
+        path = '/api/v2/incremental/tickets.json?start_time=%s' % self.TICKET_START_TIME
+        end_time = None
+        index = {}
+        with self.open_writer(self.TICKETS_FILE) as file:
+            for page in self.get_incremental_pages_from_api(self.SOURCE_INSTANCE, path, self.source_auth):
+                tickets = page.get('tickets', [])
+                for ticket, comments, error in self.run_concurrently(self.get_ticket_comments, tickets):
+                    if error:
+                        print('ERROR - Unable to export comments for ticket %s: %s' % (ticket.get('id'), error))
+                        comments = None
+                    index[ticket.get('id')] = self.write_record(file, {'ticket': ticket, 'comments': comments})
+
+                end_time = page.get('end_time') or end_time
+                print('- Exported %s tickets' % len(index))
+
+        self.write_index(index)
+        return self.file_entry(self.TICKETS_FILE, len(index)), end_time
+
+    def get_ticket_comments(self, ticket):
+        if ticket.get('status') == 'deleted':
+            return []
+
+        return list(self.iter_list_from_api(instance=self.SOURCE_INSTANCE,
+                                            path='/api/v2/tickets/%s/comments.json' % ticket.get('id'),
+                                            auth=self.source_auth,
+                                            entity_name='comments'))
+
+    def path(self, file_name):
+        return os.path.join(self.SNAPSHOT_DIR, file_name)
+
+    def open_writer(self, file_name):
+        return open(self.path(file_name), 'wb', buffering=self.WRITE_BUFFER_SIZE)
+
+    # Returns the offset and length of the record in the file
+    def write_record(self, file, record):
+        data = gzip.compress((json.dumps(record) + '\n').encode('utf-8'))
+        offset = file.tell()
+        file.write(data)
+        return offset, len(data)
+
+    # Ticket id -> (offset, length) of its latest record
+    def write_index(self, index):
+        with open(self.path(self.INDEX_FILE), 'wb', buffering=self.WRITE_BUFFER_SIZE) as file:
+            for ticket_id in sorted(index):
+                offset, length = index.get(ticket_id)
+                file.write(self.INDEX_ENTRY.pack(ticket_id, offset, length))
+
+        print('- Indexed %s tickets' % len(index))
+
+    # Rebuild the index by walking the gzip members of the tickets file, the last record of a ticket wins
+    def rebuild_index(self):
+        print('Indexing %s' % self.path(self.TICKETS_FILE))
+        index = {}
+        with open(self.path(self.TICKETS_FILE), 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            offset = 0
+            while offset < len(data):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                position = offset
+                chunks = []
+                while not decompressor.eof and position < len(data):
+                    chunks.append(decompressor.decompress(view[position:position + self.READ_CHUNK_SIZE]))
+                    position = min(position + self.READ_CHUNK_SIZE, len(data))
+
+                length = position - offset - len(decompressor.unused_data)
+                record = json.loads(b''.join(chunks).decode('utf-8'))
+                index[record.get('ticket').get('id')] = (offset, length)
+                offset += length
+            view.release()
+
+        self.write_index(index)
+
+    # Memory map the index and the tickets file for find_ticket_record
+    def open_index(self):
+        self.index_size = os.path.getsize(self.path(self.INDEX_FILE)) // self.INDEX_ENTRY.size
+        if self.index_size > 0:
+            self.tickets_file = open(self.path(self.TICKETS_FILE), 'rb')
+            self.tickets_data = mmap.mmap(self.tickets_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index_file = open(self.path(self.INDEX_FILE), 'rb')
+            self.index_data = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        print('- Opened ticket index with %s entries' % self.index_size)
+
+    # The snapshot record of a ticket, found with a binary search over the memory mapped index
+    def find_ticket_record(self, ticket_id):
+        ticket_id = int(ticket_id)
+        low = 0
+        high = self.index_size
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = self.INDEX_ENTRY.unpack_from(self.index_data,
+                                                                    middle * self.INDEX_ENTRY.size)
+            if entry_id < ticket_id:
+                low = middle + 1
+            elif entry_id > ticket_id:
+                high = middle
+            else:
+                return json.loads(gzip.decompress(self.tickets_data[offset:offset + length]).decode('utf-8'))
+
+        return None
+
+    # The latest record of each indexed ticket, in ticket id order
+    def iter_ticket_records(self):
+        for position in range(self.index_size):
+            entry_id, offset, length = self.INDEX_ENTRY.unpack_from(self.index_data,
+                                                                    position * self.INDEX_ENTRY.size)
+            yield json.loads(gzip.decompress(self.tickets_data[offset:offset + length]).decode('utf-8'))
+
+    def file_entry(self, file_name, records):
+        return {'records': records, 'bytes': os.path.getsize(self.path(file_name))}
+
+    def load_manifest(self):
+        with open(self.path(self.MANIFEST_FILE), 'r') as file:
+            return json.load(file)
+
+    # Read the records of a snapshot file in the order they were written
+    def iter_records(self, file_name):
+        with gzip.open(self.path(file_name), 'rt', encoding='utf-8') as file:
+            for line in file:
+                yield json.loads(line)
+
+    # Source user id -> {'user': ..., 'identities': [...]}
+    def load_users(self):
+        return dict((record.get('user').get('id'), record) for record in self.iter_records(self.USERS_FILE))
+
+    # (record type, source id) -> entity, see REFERENCE_TYPES. Older snapshots have no references file
+    def load_references(self):
+        if not os.path.exists(self.path(self.REFERENCES_FILE)):
+            return {}
+
+        return dict(((record.get('type'), record.get('entity').get('id')), record.get('entity'))
+                    for record in self.iter_records(self.REFERENCES_FILE))
+
+    # Source organization id -> name
+    def load_organization_names(self):
+        return dict((org.get('id'), org.get('name')) for org in self.iter_records(self.ORGS_FILE)
+                    if not org.get('deleted_at'))
+
+
+if __name__ == '__main__':
+
+    action_arg = sys.argv[1] if len(sys.argv) > 1 else 'export'
+
+    if action_arg == 'index':
+        TicketSnapshot().rebuild_index()
+    else:
+        TicketSnapshot().export()
+
+    sys.exit()
@@ -11,19 +11,23 @@ class TriggerMigration(BaseMigration):
 
         if trigger_id:
             source = self.source_client.triggers(id=trigger_id)
+            self.prepare_rule_translation([source])
             self.migrate_trigger(source)
         else:
-            for source in self.source_client.triggers():
+            sources = list(self.source_client.triggers())
+            self.prepare_rule_translation([source for source in sources if source.active])
+            for source in sources:
                 self.migrate_trigger(source)
 
+        self.print_unresolved_references()
+
     def migrate_trigger(self, source):
         if source.active:
 
-            for existing in self.target_client.triggers():
-                source_title = 'MIGRATED ' + source.title
-                if source_title == existing.title:
-                    print('Existing trigger found for %s' % source.title)
-                    return
+            title_index = self.get_target_title_index('triggers', self.target_client.triggers)
+            if 'MIGRATED ' + source.title in title_index:
+                print('Existing trigger found for %s' % source.title)
+                return
 
             print('Migrating trigger %s' % source.title)
             trigger = Trigger(title='MIGRATED ' + source.title,
@@ -50,7 +54,8 @@ class TriggerMigration(BaseMigration):
             trigger.conditions = conditions
 
             try:
-                self.target_client.triggers.create(trigger)
+                created = self.target_client.triggers.create(trigger)
+                title_index[trigger.title] = getattr(created, 'id', None)
                 print('Created trigger %s' % trigger.title)
             except APIException as ae:
                 print('ERROR - APIException: %s' % ae)
@@ -3,41 +3,49 @@
 """
 Produces a CSV with a list of all Users in ZenDesk
 
+The users, custom roles, groups and group memberships are exported concurrently. Each export is streamed
+to a JSON lines file and converted to CSV without holding the whole list in memory.
+
 """
 
+import json
+import os
 import sys
 
 from base_zendesk import BaseZendesk
-from json_to_csv import create_csv
+from json_to_csv import create_csv_from_lines
 
 
 class UserExport(BaseZendesk):
 
+    # (name, path, entity name). The users endpoint is cursor paginated
+    EXPORTS = [('users', '/api/v2/users.json?role[]=agent&role[]=admin&page[size]=100', 'users'),
+               ('custom_roles', '/api/v2/custom_roles.json', 'custom_roles'),
+               ('groups', '/api/v2/groups.json', 'groups'),
+               ('group_memberships', '/api/v2/group_memberships.json', 'group_memberships')]
+
     def main(self):
 
-        users = self.get_list_from_api(self.TARGET_INSTANCE,
-                                       '/api/v2/users.json?role[]=agent&role[]=admin',
-                                       self.target_auth,
-                                       'users')
-        create_csv(users, 'users')
-
-        roles = self.get_list_from_api(self.TARGET_INSTANCE,
-                                       '/api/v2/custom_roles.json',
-                                       self.target_auth,
-                                       'custom_roles')
-        create_csv(roles, 'custom_roles')
-
-        groups = self.get_list_from_api(self.TARGET_INSTANCE,
-                                        '/api/v2/groups.json',
-                                        self.target_auth,
-                                        'groups')
-        create_csv(groups, 'groups')
-
-        group_memberships = self.get_list_from_api(self.TARGET_INSTANCE,
-                                                   '/api/v2/group_memberships.json',
-                                                   self.target_auth,
-                                                   'group_memberships')
-        create_csv(group_memberships, 'group_memberships')
+        for export, counter, error in self.run_concurrently(self.export, self.EXPORTS, len(self.EXPORTS)):
+            if error:
+                print('ERROR - Unable to export %s: %s' % (export[0], error))
+            else:
+                print('Exported %s %s' % (counter, export[0]))
+
+    def export(self, export):
+        name, path, entity_name = export
+
+        json_filename = name + '.jsonl'
+        counter = 0
+        with open(json_filename, 'w') as file:
+            for entity in self.iter_list_from_api(self.TARGET_INSTANCE, path, self.target_auth, entity_name):
+                file.write(json.dumps(entity) + '\n')
+                counter += 1
+
+        create_csv_from_lines(json_filename, name)
+        os.remove(json_filename)
+
+        return counter
 
 
 if __name__ == '__main__':
@@ -11,23 +11,27 @@ class ViewMigration(BaseMigration):
 
         if view_id:
             source = self.source_client.views(id=view_id)
+            self.prepare_rule_translation([source])
             self.migrate_view(source)
         else:
-            for source in self.source_client.views():
+            sources = list(self.source_client.views())
+            self.prepare_rule_translation([source for source in sources if source.active])
+            for source in sources:
                 self.migrate_view(source)
 
                 # if source.active:
                 #     print(source.title + ': ' + str(source.restriction))
 
+        self.print_unresolved_references()
+
     def migrate_view(self, source):
 
         if source.active:
 
-            for existing in self.target_client.views():
-                source_title = 'MIGRATED ' + source.title
-                if source_title == existing.title:
-                    print('Existing view found for %s' % source.title)
-                    return
+            title_index = self.get_target_title_index('views', self.target_client.views)
+            if 'MIGRATED ' + source.title in title_index:
+                print('Existing view found for %s' % source.title)
+                return
 
             print('Migrating view %s' % source.title)
             view = View(title='MIGRATED ' + source.title,
@@ -76,7 +80,8 @@ class ViewMigration(BaseMigration):
                 view.restriction = {'type': source_rest.get('type'), 'id': restr_id}
 
             print('Creating view %s' % view.title)
-            self.target_client.views.create(view)
+            created = self.target_client.views.create(view)
+            title_index[view.title] = getattr(created, 'id', None)
 
 
 if __name__ == '__main__':